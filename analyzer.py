@@ -16,16 +16,43 @@ import sys
 import traceback
 import warnings
 import csv
+import tempfile
+import queue
+import threading
+import hashlib
+import pickle
+import sqlite3
+import time
+import zlib
+import json
+import base64
+import http.client
+import http.server
+import socketserver
+import socket
+import multiprocessing
+import itertools
+import inspect
+import asyncio
+from concurrent import futures
+from multiprocessing import shared_memory
 from PyQt4 import QtGui, QtCore
 from skimage import io, filter, transform
+from scipy import ndimage as ndi
+from PIL import Image
 import numpy as np
+try:
+    import h5py
+except ImportError:
+    h5py = None # HDF5 export is not available
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib.ticker import AutoMinorLocator
 
 
 __version__ = '1.4'
-_formats = [".bmp", ".jpg", ".png"]
+_formats = [".bmp", ".jpg", ".png", ".tif", ".tiff"]
+_stack_formats = [".tif", ".tiff"] # multi-page formats, one page per wavelength
 _cal_format = ".csv"
 # _filter = {0: [0], 1: [0], 2: [1, 2], 3: [1, 2]}
 _filter = {0: [0], 45: [1], 90: [2], 135: [3]}
@@ -34,6 +61,2335 @@ _size = QtCore.QSize(640, 480)+QtCore.QSize(4, 4)
 _minsize = QtCore.QSize(640, 480)+QtCore.QSize(4, 4)
 _zoom_level = [1/5.0, 1/4.0, 1/3.0, 1/2.0, 2/3.0, 4/5.0, 1.0, \
         5/4.0, 3/2.0, 2.0, 3.0, 4.0, 5.0]
+_margin = 256 # extra pixels around the viewport rendered in advance
+_max_edge_points = 200000 # maximum number of edge points drawn at once
+_track_factor = 2 # downsampling factor of the frames used for drift tracking
+_config_dir = os.path.join(os.path.expanduser('~'), '.npc_analyzer')
+_cache_file = os.path.join(_config_dir, 'cache.sqlite')
+_cache_size = 256*2**20 # bytes kept in the result cache before evicting
+_cache_touch = 30.0 # seconds between two writes of the last use times of cached results
+_cache_version = 4 # bump when the analysis results change, older cached results are then missed
+_store_file = os.path.join(_config_dir, 'results.sqlite')
+_page_size = 500 # rows of the results store shown in the table at once
+_session_format = '.npcs'
+_export_chunk = 10000 # rows written at once by Exporter
+_watch_interval = 0.5 # seconds between two scans of a watched directory
+_watch_queue = 16 # frames waiting for analysis before the watcher stops scanning
+_pipeline_depth = 8 # frames waiting between two pipeline stages
+_sweep_frames = 12 # frames of the current directory used by a sweep from the gui
+_claim_heartbeat = 60 # seconds between two touches of the claim of a working campaign node
+_claim_timeout = 600 # seconds without touch after which a claim is stale, see Campaign.release
+_service_host = '127.0.0.1' # the analysis service only listens on loopback
+_service_port = 8765
+_session_dtype = [('wavelength', 'U16'), ('reflectivity', 'U16'),
+                  ('polarization', 'U16'), ('fwhm', 'U16'), ('page', 'i4'),
+                  ('scale_factor', 'f8'), ('rect', 'i4', 4), ('sigma', 'f8'),
+                  ('sigma_line', 'f8'), ('background', '?'), ('scroll', 'i4', 2)]
+_session_texts = 4 # leading text fields of _session_dtype, sized from the data when saved
+
+
+_sigma_steps = 20 # sigma slider steps per unit, fine enough for the _sigmas grid
+_sigmas = np.arange(0.0, 5.01, 0.25) # sigmas scanned by NPCEngine.auto_sigma
+_plateau_tol = 0.01 # relative reflectivity change still counted as stable
+_params = {'inner_std': 10.0,
+           'inner_factor': 0.9,
+           'outer_std': 3.0,
+           'outer_factor': 1.1,
+           'outer_n': 10,
+           'outer_method': 'squares',
+           'mask_lines': False,
+           'sigma_line': 0.0,
+           'line_window': 45.0} # optimizer parameters used by NPCEngine.analyze_edges
+_rings = 8 # rings of the annulus background estimator
+_canny_tile = 512 # side of the tiles of NPCEngine.canny, larger matrices are tiled
+_canny_threads = os.cpu_count() or 1 # threads running the canny tiles
+_canny_min_threads = 3 # with fewer threads canny runs in one pass, a tile costs two canny runs
+_line_width = 3 # width in pixels of the lines masked out of the brightness regions
+_accumulators = 8 # hough accumulators kept by NPCEngine, see accumulator
+_ransac_hypotheses = 64 # circles tried at once by NPCEngine.fit_circle
+_ransac_points = 2000 # edge points used to score the circles
+_ransac_tol = 0.15 # distance to the circle still counted as inlier, relative to the point spread
+_radius_quantile = 0.02 # inlier distances left out at each end of d_min and d_max
+_ring_width = 0.1 # width of the annulus rings, relative to the pattern radius
+
+
+class NPCEngine(object):
+    """ The headless part of the analysis. It knows nothing about widgets:
+        frames are plain ndarrays, coordinates are native pixels and rects
+        are (x, y, w, h) tuples, so it can also run in batch jobs and workers.
+    """
+    def __init__(self, params=None, threads=_canny_threads):
+        self.params = dict(_params)
+        if params:
+            self.params.update(params)
+        self.threads = threads # threads running the canny tiles, 1 in pool workers
+        self.darks = {} # background matrices kept in memory, see get_dark
+        self.cache = None # ResultCache, if results should be cached
+        self.accumulators = {} # recent hough accumulators, keyed by edge map and angles
+    
+    # image loading methods
+    def array2gray(self, array):
+        if np.ndim(array) == 3:
+            array = np.dot(array[..., :3], [0.2989, 0.5870, 0.1140]) # ignore alpha channel
+        gray = np.require(array, np.uint8, 'C')
+        return gray
+    
+    def load_gray(self, image, background='', page=None):
+        """ Read the image as a native gray matrix, and subtract the
+            background image from it if one is given.
+        
+        Keyword arguments:
+        page -- page index, only for multi-page images.
+        """
+        if page is None:
+            gray = self.array2gray(io.imread(image))
+        else:
+            gray = self.read_page(image, page)
+        return self.subtract_dark(gray, background)
+    
+    def subtract_dark(self, gray, background):
+        if background:
+            gray = gray.astype(int)-self.get_dark(background)
+            gray[gray < 0] = 0
+        return np.require(gray, np.uint8, 'C')
+    
+    def is_stack(self, image):
+        """ True for multi-page images only, a single-page tiff is a frame. """
+        if os.path.splitext(image)[1].lower() not in _stack_formats:
+            return False
+        try:
+            return self.count_pages(image) > 1
+        except:
+            return False
+    
+    def page2gray(self, imag):
+        array = np.asarray(imag)
+        if (array.dtype.kind in 'ui') and (array.dtype.itemsize > 1):
+            array = array/(np.iinfo(array.dtype).max/255.0) # e.g. 16-bits pages
+        return self.array2gray(array)
+    
+    def count_pages(self, stack):
+        imag = Image.open(stack)
+        try:
+            return getattr(imag, 'n_frames', 1)
+        finally:
+            imag.close()
+    
+    def read_page(self, stack, page):
+        imag = Image.open(stack)
+        try:
+            imag.seek(page)
+            return self.page2gray(imag)
+        finally:
+            imag.close()
+    
+    def iter_pages(self, stack):
+        """ Yield (page, gray) for each page of a multi-page image. Pages are
+            decoded one at a time, the stack is never loaded as a whole.
+        """
+        imag = Image.open(stack)
+        try:
+            page = 0
+            while True:
+                try:
+                    imag.seek(page)
+                except EOFError:
+                    break
+                yield page, self.page2gray(imag)
+                page += 1
+        finally:
+            imag.close()
+    
+    def discover(self, images):
+        """ Expand the images into (image, page) items, page is None for
+            single-frame images.
+        """
+        items = []
+        for image in images:
+            if self.is_stack(image):
+                items.extend((image, page) for page in range(self.count_pages(image)))
+            else:
+                items.append((image, None))
+        return items
+    
+    def get_dark(self, background):
+        """ The background image as a gray matrix. Backgrounds are shared by
+            many frames, so they are read once and then kept in memory, or
+            attached from shared memory in batch workers.
+        """
+        key = (background, os.path.getmtime(background))
+        if key not in self.darks:
+            self.darks[key] = self.array2gray(io.imread(background))
+        return self.darks[key]
+    
+    def integral(self, matrix, valid=None):
+        """ Integral images of the matrix and of its square, padded with a
+            leading row and column of zeros. Any block mean and std can then
+            be read in constant time, see block_stats.
+        
+        Keyword arguments:
+        valid -- bool ndarray, if given, only these pixels are counted and
+            a third integral image holds their number.
+        """
+        h, w = matrix.shape
+        ii = np.zeros((h+1, w+1))
+        ii2 = np.zeros((h+1, w+1))
+        matrix = matrix.astype(float)
+        if valid is not None:
+            matrix = matrix*valid
+        ii[1:, 1:] = matrix.cumsum(0).cumsum(1)
+        ii2[1:, 1:] = (matrix**2).cumsum(0).cumsum(1)
+        if valid is None:
+            return ii, ii2
+        ic = np.zeros((h+1, w+1))
+        ic[1:, 1:] = valid.cumsum(0).cumsum(1)
+        return ii, ii2, ic
+    
+    def block_stats(self, integral, x1, x2, y1, y2):
+        """ Statistic on matrix[y1:y2, x1:x2], following the slicing rules.
+            With a count image, see integral, only the valid pixels count.
+        
+        Returns:
+        int size, float mean, float std.
+        """
+        ii, ii2 = integral[:2]
+        h, w = ii.shape[0]-1, ii.shape[1]-1
+        x1, x2 = slice(x1, x2).indices(w)[:2]
+        y1, y2 = slice(y1, y2).indices(h)[:2]
+        size = max(x2-x1, 0)*max(y2-y1, 0)
+        if size and len(integral) > 2:
+            ic = integral[2]
+            size = int(round(ic[y2, x2]-ic[y1, x2]-ic[y2, x1]+ic[y1, x1]))
+        if not size:
+            return 0, None, None
+        total = ii[y2, x2]-ii[y1, x2]-ii[y2, x1]+ii[y1, x1]
+        total2 = ii2[y2, x2]-ii2[y1, x2]-ii2[y2, x1]+ii2[y1, x1]
+        mean = total/size
+        std = np.sqrt(max(total2/size-mean**2, 0.0))
+        return size, mean, std
+    
+    def downsample(self, matrix, factor):
+        """ Block mean of the matrix, the trailing rows and columns which
+            don't fill a whole block are dropped.
+        """
+        h, w = matrix.shape
+        h, w = h//factor, w//factor
+        blocks = matrix[:h*factor, :w*factor].reshape(h, factor, w, factor)
+        return blocks.mean(axis=(1, 3))
+    
+    # calibrating and parsing methods
+    def modified(self, sample):
+        if not sample[1]:
+            sample[1] = sample[0]
+        return sample
+    
+    def get_raw_cal_data(self, cal):
+        data = []
+        
+        with open(cal) as f:
+            reader = csv.reader(f)
+            flag = 0
+            data.append([])
+            for row in reader:
+                try:
+                    wavelength = float(row[0])
+                    data[-1].append(row)
+                    if not flag:
+                        flag = 1
+                except:
+                    if flag:
+                        flag = 0
+                        data.append([])
+        return data
+    
+    def get_cal_data(self, cal):
+        """ Read the calibration file, one block of rows per polarization
+            turn, with the empty cells filled by the values above them.
+        """
+        data = self.get_raw_cal_data(cal)
+        current_value = self.modified(data[0][0])[:]
+        for i in range(len(data)):
+            for j in range(len(data[i])):
+                sample = data[i][j]
+                for k in range(len(sample)):
+                    sample = self.modified(sample)
+                    if sample[k]:
+                        current_value[k] = sample[k]
+                    else:
+                        sample[k] = current_value[k]
+        return data
+    
+    def find_nearest_index(self, array, value):
+        idx = (np.abs(array-value)).argmin()
+        return idx
+    
+    def parse_turn(self, name):
+        """ Get the peak wavelength and the polarization turn from the image
+            name, without suffix. Raises ValueError if there is no peak.
+        
+        Returns:
+        float peak, int turn.
+        """
+        tokens = name.split('_')
+        if len(tokens) < 2:
+            peak = tokens[0]
+            turn = 0
+        else:
+            peak, turn = tokens[:2]
+        peak = float(peak.split('n')[0])
+        try:
+            turn = int(turn)
+        except:
+            turn = 0
+        return peak, turn
+    
+    def cal_block(self, cal_data, turn):
+        """ The calibration rows of the given polarization turn. """
+        return np.array([row for i in _filter[turn] for row in cal_data[i]])
+    
+    def empty_info(self):
+        return {'wavelength':'',
+                'FWHM':'',
+                'exposure':'',
+                'brightness':'',
+                'gain':'',
+                'polarization':''}
+    
+    def fill_info(self, info, row):
+        """ Fill the info dict with one calibration row. """
+        info['FWHM'] = row[2]
+        info['exposure'] = row[3]
+        info['brightness'] = row[4]
+        info['gain'] = row[5]
+        info['polarization'] = row[6]
+        info['wavelength'] = '{0:.3f}'.format(float(row[1]))
+        return info
+    
+    def parse_stack_turn(self, name):
+        """ The polarization turn of a multi-page image: the last token of
+            its name which is a known turn, 0 if there is none.
+        """
+        turn = 0
+        for token in name.split('_'):
+            try:
+                if int(token) in _filter:
+                    turn = int(token)
+            except ValueError:
+                pass
+        return turn
+    
+    def page_info(self, name, page, cal_data=None):
+        """ Info of one page of a multi-page image: the pages follow the
+            calibration rows of the polarization turn of the stack, one page
+            per row. Without calibration data the info stays empty.
+        """
+        info = self.empty_info()
+        try:
+            if cal_data:
+                part_data = self.cal_block(cal_data, self.parse_stack_turn(name))
+                if page < len(part_data):
+                    self.fill_info(info, part_data[page])
+        except:
+            pass
+        return info
+    
+    def parse_name(self, name, cal_data=None):
+        """ Parse the image name to get more information.
+        
+        Keyword arguments:
+        name -- the name of image, without suffix.
+        cal_data -- calibration data, see get_cal_data. If None, only the
+            wavelength is parsed.
+        
+        Returns:
+        dict with wavelength, FWHM, exposure, brightness, gain and
+        polarization, all strings, empty if unknown.
+        """
+        info = self.empty_info()
+        try:
+            peak, turn = self.parse_turn(name)
+            info['wavelength'] = '{0:.3f}'.format(peak)
+            # calibration
+            if cal_data:
+                part_data = self.cal_block(cal_data, turn)
+                peaks = part_data[:, 1].astype(float)
+                idx = self.find_nearest_index(peaks, peak)
+                self.fill_info(info, part_data[idx])
+        except:
+            pass
+        return info
+    
+    def is_background(self, f, info, suffix):
+        exposure = info['exposure']
+        gain = info['gain']
+        polarization = info['polarization']
+        
+        name, ext = os.path.splitext(f)
+        if suffix:
+            c0 = bool(ext == suffix)
+        else:
+            c0 = ext in _formats
+        c1 = False
+        try:
+            parts = name.split('_')
+            if '/'.join(parts[1:3]) == exposure:
+                if (len(parts) == 3) or (parts[3] == polarization) or (parts[3] == gain):
+                    c1 = True
+        except:
+            pass
+        return (c0 and c1)
+    
+    def find_backgrounds(self, path, info, suffix):
+        """ Names of the background images in path matching the info. If
+            suffix is None, any single-frame image is accepted.
+        """
+        bgs = [f for f in os.listdir(path) if self.is_background(f, info, suffix)]
+        if suffix is None:
+            bgs = [f for f in bgs if not self.is_stack(os.path.join(path, f))]
+        return bgs
+    
+    # locating methods
+    def locate_pattern(self, matrix, size=None, factor=4):
+        """ Find the pattern automatically, on a downsampled copy of the
+            frame: the pattern is where the edge density is the highest.
+        
+        Keyword arguments:
+        matrix -- native gray matrix.
+        size -- (w, h) of the roi to return, e.g. the size of a previous
+            selection. If None, the roi is fitted to the edges connected to
+            the densest window, so a pattern larger than it isn't cut.
+        factor -- downsampling factor.
+        
+        Returns:
+        native (x, y, w, h) roi, None if no edge is found.
+        """
+        small = self.downsample(matrix, factor)
+        magnitude = filter.sobel(small)
+        edges = magnitude > np.mean(magnitude)+2*np.std(magnitude)
+        if not edges.any():
+            return None
+        rows, cols = small.shape
+        if size is None:
+            wx = wy = max(min(rows, cols)//3, 1)
+        else:
+            wx = min(max(int(size[0]//factor), 1), cols)
+            wy = min(max(int(size[1]//factor), 1), rows)
+        ii = np.zeros((rows+1, cols+1))
+        ii[1:, 1:] = edges.cumsum(0).cumsum(1)
+        density = ii[wy:, wx:]-ii[:-wy, wx:]-ii[wy:, :-wx]+ii[:-wy, :-wx]
+        ty, tx = np.unravel_index(np.argmax(density), density.shape)
+        y, x = np.nonzero(edges[ty:ty+wy, tx:tx+wx])
+        H, W = matrix.shape
+        if size is None:
+            labels, count = ndi.label(ndi.binary_dilation(edges, iterations=2))
+            window = labels[ty:ty+wy, tx:tx+wx]
+            y, x = np.nonzero(edges & np.isin(labels, window[edges[ty:ty+wy, tx:tx+wx]]))
+            pad = 0.2*max(np.ptp(x), np.ptp(y), 1)
+            x1 = int(max((np.min(x)-pad)*factor, 0))
+            y1 = int(max((np.min(y)-pad)*factor, 0))
+            x2 = int(min((np.max(x)+1+pad)*factor, W))
+            y2 = int(min((np.max(y)+1+pad)*factor, H))
+            return (x1, y1, x2-x1, y2-y1)
+        w, h = min(int(size[0]), W), min(int(size[1]), H)
+        xc = (tx+np.mean(x)+0.5)*factor
+        yc = (ty+np.mean(y)+0.5)*factor
+        x1 = int(min(max(round(xc-w/2), 0), W-w))
+        y1 = int(min(max(round(yc-h/2), 0), H-h))
+        return (x1, y1, w, h)
+    
+    def phase_shift(self, ref, cur):
+        """ Estimate how far the content of cur moved with respect to ref,
+            by phase correlation. Both must have the same shape.
+        
+        Returns:
+        float dx, float dy -- with sub-pixel accuracy.
+        """
+        window = np.outer(np.hanning(ref.shape[0]), np.hanning(ref.shape[1]))
+        f_ref = np.fft.fft2((ref-np.mean(ref))*window)
+        f_cur = np.fft.fft2((cur-np.mean(cur))*window)
+        cross = f_cur*np.conj(f_ref)
+        cross /= np.abs(cross)+1e-12
+        corr = np.fft.ifft2(cross).real
+        peak = np.unravel_index(np.argmax(corr), corr.shape)
+        shift = []
+        for axis in range(2):
+            n = corr.shape[axis]
+            i = peak[axis]
+            idx = list(peak)
+            idx[axis] = (i-1)%n
+            c_m = corr[tuple(idx)]
+            idx[axis] = (i+1)%n
+            c_p = corr[tuple(idx)]
+            c_0 = corr[peak]
+            denom = c_m-2*c_0+c_p
+            delta = 0.5*(c_m-c_p)/denom if denom else 0.0
+            d = i+delta
+            shift.append(d-n if d > n/2 else d)
+        return shift[1], shift[0]
+    
+    def shift_roi(self, roi, dx, dy, shape):
+        """ Move the roi by (dx, dy), keeping it inside a matrix of shape. """
+        x, y, w, h = roi
+        rows, cols = shape
+        x = int(min(max(round(x+dx), 0), max(cols-w, 0)))
+        y = int(min(max(round(y+dy), 0), max(rows-h, 0)))
+        return (x, y, w, h)
+    
+    # optimizing methods
+    def p_isvalid(self, dmax, i, N, x, y):
+        z = x+y*1j
+        return (np.abs(z) >= dmax) and (np.pi/N*2*i <= self.angle(z) <= np.pi/N*2*(i+1))
+    
+    def isvalid(self, dmax, i, N, x1, x2, y1, y2):
+        valid = self.p_isvalid(dmax, i, N, x1, y1) and self.p_isvalid(dmax, i, N, x1, y2) \
+                and self.p_isvalid(dmax, i, N, x2, y1) and self.p_isvalid(dmax, i, N, x2, y2)
+        return valid
+    
+    def angle(self, z):
+        return np.angle(z) if np.angle(z) >= 0 else 2*np.pi+np.angle(z)
+    
+    def inner_optimizer(self, integral, x1, y1, xc, yc, dmin, std, factor):
+        """ Get the inner brightness and rect for the selected area.
+        
+        Note that when selected area is empty, brightness would be set to -1.
+        
+        Returns:
+        float brightnss, tuple rect.
+        """
+        inner_b = -1
+        inner_rect = (0, 0, 0, 0)
+        
+        eta = 1.0
+        while True:
+            a = eta*dmin/np.sqrt(2)
+            x1_i = x1+int(round(xc-a))
+            x2_i = x1+int(round(xc+a))
+            y1_i = y1+int(round(yc-a))
+            y2_i = y1+int(round(yc+a))
+            size, mean, std_i = self.block_stats(integral, x1_i, x2_i, y1_i, y2_i)
+            inner_rect = (x1_i, y1_i, x2_i-x1_i, y2_i-y1_i)
+            if size:
+                inner_b = mean
+                if std_i <= std:
+                    break
+                else:
+                    eta *= factor
+            else:
+                break
+        return inner_b, inner_rect
+    
+    def outer_optimizer(self, integral, x1, y1, xc, yc, dmax, std, factor, N=4):
+        """ Get the outer brightness and rects for the selected area.
+        
+        Note that when selected area is empty, brightness would be set to -1.
+        
+        Returns:
+        list b_list, list rect_list.
+        """
+        outer_b_list = []
+        outer_rect_list = []
+        for i in range(N):
+            outer_b = -1
+            outer_rect = (0, 0, 0, 0)
+            
+            eta = 1.0
+            d = 1.2*dmax
+            while True:
+                a = 1.0*eta
+                xc_o = d*np.cos(np.pi/N*(2*i+1))
+                yc_o = d*np.sin(np.pi/N*(2*i+1))
+                x1_o = xc_o-a
+                x2_o = xc_o+a
+                y1_o = yc_o-a
+                y2_o = yc_o+a
+                if self.isvalid(dmax, i, N, x1_o, x2_o, y1_o, y2_o):
+                    x1_o = max(int(round(x1+xc+x1_o)), 0)
+                    x2_o = max(int(round(x1+xc+x2_o)), 0)
+                    y1_o = max(int(round(y1+yc+y1_o)), 0)
+                    y2_o = max(int(round(y1+yc+y2_o)), 0)
+                    size, brightness, std_o = self.block_stats(integral,
+                            x1_o, x2_o, y1_o, y2_o)
+                    if size:
+                        if std_o <= std:
+                            eta *= factor
+                            outer_b = brightness
+                            outer_rect = (x1_o, y1_o, x2_o-x1_o, y2_o-y1_o)
+                        else:
+                            break
+                    else:
+                        eta *= factor
+                        continue
+                else:
+                    break
+            outer_b_list.append(outer_b)
+            outer_rect_list.append(outer_rect)
+        return outer_b_list, outer_rect_list
+    
+    def annulus_optimizer(self, matrix, x1, y1, xc, yc, dmax, std, N=4, valid=None):
+        """ Get the outer brightness and rects like outer_optimizer, from N
+            annular sectors around the pattern instead of squares. The pixels
+            around the pattern are binned by ring and sector in one bincount
+            pass, then each sector keeps the rings from the inside out while
+            its std stays under the threshold.
+        
+        Note that when a sector is empty or too noisy from its first ring,
+        brightness would be set to -1.
+        
+        Returns:
+        list b_list, list rect_list.
+        """
+        b_list = [-1]*N
+        rect_list = [(0, 0, 0, 0)]*N
+        cx, cy = x1+xc, y1+yc
+        r0 = 1.2*dmax
+        width = max(_ring_width*dmax, 2.0)
+        r1 = r0+_rings*width
+        h, w = matrix.shape
+        xa, xb = max(int(np.floor(cx-r1)), 0), min(int(np.ceil(cx+r1))+1, w)
+        ya, yb = max(int(np.floor(cy-r1)), 0), min(int(np.ceil(cy+r1))+1, h)
+        if (xa >= xb) or (ya >= yb):
+            return b_list, rect_list
+        dx = (np.arange(xa, xb)-cx)[None, :]
+        dy = (np.arange(ya, yb)-cy)[:, None]
+        ring = np.floor((np.hypot(dx, dy)-r0)/width).astype(int)
+        theta = np.arctan2(dy, dx) % (2*np.pi)
+        sector = np.minimum((theta*N/(2*np.pi)).astype(int), N-1)
+        inside = (ring >= 0) & (ring < _rings)
+        if valid is not None:
+            inside &= valid[ya:yb, xa:xb]
+        labels = (ring*N+sector)[inside]
+        values = matrix[ya:yb, xa:xb][inside].astype(float)
+        size = _rings*N
+        n = np.bincount(labels, minlength=size).reshape(_rings, N).cumsum(0)
+        s1 = np.bincount(labels, values, size).reshape(_rings, N).cumsum(0)
+        s2 = np.bincount(labels, values**2, size).reshape(_rings, N).cumsum(0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = s1/n
+            std_s = np.sqrt(np.maximum(s2/n-mean**2, 0.0))
+        passed = (n == 0) | (std_s <= std) # empty rings are outside the frame
+        k = np.cumprod(passed, axis=0).sum(0) # rings kept in each sector
+        for i in range(N):
+            if k[i] and n[k[i]-1, i]:
+                b_list[i] = mean[k[i]-1, i]
+                rect_list[i] = self.sector_rect(cx, cy, r0, r0+k[i]*width,
+                        2*np.pi*i/N, 2*np.pi*(i+1)/N, w, h)
+        return b_list, rect_list
+    
+    def sector_rect(self, cx, cy, r_in, r_out, a0, a1, w, h):
+        """ Bounding rect of an annular sector, clipped to the frame. """
+        angles = [a0, a1]+[a for a in np.arange(0, 2*np.pi, np.pi/2) if a0 < a < a1]
+        xs = [cx+r*np.cos(a) for r in [r_in, r_out] for a in angles]
+        ys = [cy+r*np.sin(a) for r in [r_in, r_out] for a in angles]
+        x_1, x_2 = max(int(np.floor(min(xs))), 0), min(int(np.ceil(max(xs))), w)
+        y_1, y_2 = max(int(np.floor(min(ys))), 0), min(int(np.ceil(max(ys))), h)
+        return (x_1, y_1, max(x_2-x_1, 0), max(y_2-y_1, 0))
+    
+    def kasa_fit(self, x, y):
+        """ Algebraic least squares circle through the points.
+        
+        Returns:
+        xc, yc, r -- None if the points are degenerate.
+        """
+        A = np.column_stack((x, y, np.ones(len(x))))
+        (a, b, c), _, rank, _ = np.linalg.lstsq(A, -(x**2+y**2), rcond=-1)
+        xc, yc = -a/2, -b/2
+        r2 = xc**2+yc**2-c
+        if rank < 3 or r2 <= 0:
+            return None
+        return xc, yc, np.sqrt(r2)
+    
+    def fit_circle(self, x, y):
+        """ Robust circle through the edge points: a batch of circles through
+            random point triples is scored at once on a sample of the points,
+            then the best one is refined by kasa_fit on its inliers. Circles
+            larger than the point spread or centered outside the points are
+            rejected, and the inlier band is scaled to the spread, so that
+            the near-straight triples can't win by covering every point. The
+            random state is fixed, so a frame always gives the same circle.
+        
+        Returns:
+        xc, yc, r, inlier mask -- None if no circle is found.
+        """
+        x = np.asarray(x, float)
+        y = np.asarray(y, float)
+        n = len(x)
+        if n < 3:
+            return None
+        spread = max(np.ptp(x), np.ptp(y))
+        if spread <= 0:
+            return None
+        tol = _ransac_tol*spread
+        rng = np.random.RandomState(0)
+        triples = rng.randint(0, n, (3, _ransac_hypotheses))
+        x1, x2, x3 = x[triples]
+        y1, y2, y3 = y[triples]
+        s1, s2, s3 = x1**2+y1**2, x2**2+y2**2, x3**2+y3**2
+        d = 2*(x1*(y2-y3)+x2*(y3-y1)+x3*(y1-y2))
+        ok = np.abs(d) > 1e-9
+        d[~ok] = 1.0
+        ux = (s1*(y2-y3)+s2*(y3-y1)+s3*(y1-y2))/d
+        uy = (s1*(x3-x2)+s2*(x1-x3)+s3*(x2-x1))/d
+        r = np.hypot(x1-ux, y1-uy)
+        ok &= (r <= spread) & (ux >= x.min()) & (ux <= x.max()) & \
+                (uy >= y.min()) & (uy <= y.max())
+        sample = rng.choice(n, min(n, _ransac_points), replace=False)
+        dist = np.hypot(x[sample][None, :]-ux[:, None], y[sample][None, :]-uy[:, None])
+        score = (np.abs(dist-r[:, None]) <= tol).sum(1)
+        score[~ok] = -1
+        best = np.argmax(score)
+        if score[best] < 3:
+            return None
+        circle = (ux[best], uy[best], r[best])
+        for i in range(2):
+            xc, yc, rc = circle
+            inliers = np.abs(np.hypot(x-xc, y-yc)-rc) <= tol
+            if inliers.sum() < 3:
+                return None
+            fit = self.kasa_fit(x[inliers], y[inliers])
+            if fit is None:
+                break
+            circle = fit
+        xc, yc, rc = circle
+        return xc, yc, rc, np.abs(np.hypot(x-xc, y-yc)-rc) <= tol
+    
+    def pattern_geometry(self, x, y):
+        """ Center and extreme distances of the pattern edges, stray edges
+            left out by fit_circle, the extremes taken as robust quantiles of
+            the inlier distances. Falls back to the mean and the extreme
+            distances of all the edges.
+        
+        Returns:
+        xc, yc, d_min, d_max.
+        """
+        fit = self.fit_circle(x, y)
+        if fit is not None:
+            xc, yc, r, inliers = fit
+            if inliers.any():
+                d = np.sqrt((x[inliers]-xc)**2+(y[inliers]-yc)**2)
+                d_min, d_max = np.percentile(d, [100*_radius_quantile,
+                        100*(1-_radius_quantile)])
+                return xc, yc, d_min, d_max
+        xc = np.mean(x)
+        yc = np.mean(y)
+        d = np.sqrt((x-xc)**2+(y-yc)**2)
+        return xc, yc, np.min(d), np.max(d)
+    
+    def cal_reflectivity(self, inner_b, outer_bs):
+        reflectivity = None
+        
+        if inner_b != None:
+            outer_bs = np.array(outer_bs)
+            mask = (outer_bs >= 0)
+            outer_bs = outer_bs[mask]
+            if (inner_b != -1) and len(outer_bs):
+                reflectivity = inner_b/np.mean(outer_bs)
+        return reflectivity
+    
+    # analysis methods
+    def edges(self, matrix, sigma, roi=None):
+        """ Canny edges of the whole matrix, or of the roi only.
+        
+        Returns:
+        edges, x1, y1 -- edges is None if the roi is empty.
+        """
+        if roi is None:
+            return self.canny(matrix, sigma), 0, 0
+        x1, y1, w, h = roi
+        part = matrix[y1:y1+h, x1:x1+w]
+        if not part.size:
+            return None, x1, y1
+        return self.canny(part, sigma), x1, y1
+    
+    def canny_thresholds(self, matrix):
+        """ The default hysteresis thresholds of filter.canny, in the units
+            it takes them in. Recent versions default to None, meaning 10%
+            and 20% of the dtype maximum.
+        
+        Returns:
+        low, high.
+        """
+        params = inspect.signature(filter.canny).parameters
+        low = params['low_threshold'].default
+        high = params['high_threshold'].default
+        if low is None or high is None:
+            kind = matrix.dtype.kind
+            dtype_max = float(np.iinfo(matrix.dtype).max) if kind in 'ui' else 1.0
+            low = 0.1*dtype_max if low is None else low
+            high = 0.2*dtype_max if high is None else high
+        return low, high
+    
+    def canny_tile(self, matrix, sigma, box, thresholds):
+        """ Low and high threshold masks of the core of one tile. The tile is
+            cut with its halo, and canny with equal thresholds gives the
+            thresholded maxima without linking them.
+        """
+        (ya, yb, xa, xb), (y0, y1, x0, x1) = box
+        part = matrix[ya:yb, xa:xb]
+        core = (slice(y0-ya, y1-ya), slice(x0-xa, x1-xa))
+        low, high = thresholds
+        return (filter.canny(part, sigma, low, low)[core],
+                filter.canny(part, sigma, high, high)[core])
+    
+    def canny(self, matrix, sigma, tile=_canny_tile):
+        """ Same edges as filter.canny, with the matrix cut into tiles run on
+            a thread pool. Each tile is extended by a halo covering the
+            gaussian, sobel, non-maximum suppression and mask erosion
+            footprints, so that its core is computed as in a single pass.
+            The hysteresis, which links edges across tiles, is done once on
+            the whole stitched masks. Each tile runs canny twice, so the
+            matrix is only tiled with at least _canny_min_threads threads.
+        """
+        h, w = matrix.shape
+        if ((h <= tile) and (w <= tile)) or (self.threads < _canny_min_threads):
+            return filter.canny(matrix, sigma=sigma)
+        halo = int(4.0*sigma+0.5)+3 # gaussian truncated at 4 sigma, plus 3x3 steps
+        boxes = []
+        for y0 in range(0, h, tile):
+            for x0 in range(0, w, tile):
+                y1, x1 = min(y0+tile, h), min(x0+tile, w)
+                boxes.append(((max(y0-halo, 0), min(y1+halo, h),
+                        max(x0-halo, 0), min(x1+halo, w)), (y0, y1, x0, x1)))
+        thresholds = self.canny_thresholds(matrix)
+        low_mask = np.zeros((h, w), bool)
+        high_mask = np.zeros((h, w), bool)
+        with futures.ThreadPoolExecutor(min(self.threads, len(boxes))) as pool:
+            jobs = [pool.submit(self.canny_tile, matrix, sigma, box, thresholds) \
+                    for box in boxes]
+            for box, job in zip(boxes, jobs):
+                y0, y1, x0, x1 = box[1]
+                low_mask[y0:y1, x0:x1], high_mask[y0:y1, x0:x1] = job.result()
+        labels, count = ndi.label(low_mask, np.ones((3, 3), bool))
+        good = np.zeros(count+1, bool)
+        good[labels[high_mask]] = True
+        good[0] = False
+        return good[labels]
+    
+    def line_angles(self):
+        """ Angles of the hough transform: those of the default range that
+            are in the windows around 0 and 90 degrees. None for the whole
+            default range.
+        """
+        window = self.params['line_window']
+        if window >= 45.0:
+            return None
+        theta = np.linspace(-np.pi/2, np.pi/2, 180)
+        w = np.deg2rad(window)
+        return theta[(np.abs(theta) <= w) | (np.abs(theta) >= np.pi/2-w)]
+    
+    def accumulator(self, edges):
+        """ Hough accumulator of the edge map, computed once per edge map
+            and angle window.
+        
+        Returns:
+        h, theta, d -- see transform.hough_line.
+        """
+        key = (edges.shape, hashlib.sha1(np.packbits(edges)).hexdigest(),
+                self.params['line_window'])
+        if key not in self.accumulators:
+            if len(self.accumulators) >= _accumulators:
+                del self.accumulators[next(iter(self.accumulators))]
+            angles = self.line_angles()
+            if angles is None:
+                self.accumulators[key] = transform.hough_line(edges)
+            else:
+                self.accumulators[key] = transform.hough_line(edges, theta=angles)
+        return self.accumulators[key]
+    
+    def hough_lines(self, edges, x1=0, y1=0, method=0):
+        """ Lines of the edge map of the roi at x1, y1. With method 0, the
+            hough peaks are clipped to the roi, all at once: each line is cut
+            by the 4 borders, and the 2 middle cuts in (x, y) order are kept.
+            With method 1, the segments of the probabilistic transform.
+        
+        Returns:
+        int ndarray of (x_a, y_a, x_b, y_b) rows.
+        """
+        if method == 1:
+            segments = transform.probabilistic_hough_line(edges, threshold=50,
+                    line_length=80, line_gap=5)
+            lines = np.array([p0+p1 for p0, p1 in segments], int).reshape(-1, 4)
+            return lines+[x1, y1, x1, y1]
+        h, theta, d = self.accumulator(edges)
+        _, angles, dists = transform.hough_line_peaks(h, theta, d)
+        angles = np.asarray(angles, float)
+        dists = np.asarray(dists, float)
+        rows, cols = edges.shape
+        zeros = np.zeros_like(dists)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sin, cos = np.sin(angles), np.cos(angles)
+            X = np.column_stack((zeros, zeros+cols, np.round(dists/cos),
+                    np.round((dists-rows*sin)/cos)))+x1
+            Y = np.column_stack((np.round(dists/sin), np.round((dists-cols*cos)/sin),
+                    zeros, zeros+rows))+y1
+        order = np.lexsort((Y, X), axis=-1)
+        index = np.arange(len(dists))[:, None]
+        X = X[index, order][:, 1:3]
+        Y = Y[index, order][:, 1:3]
+        finite = np.isfinite(X).all(1) & np.isfinite(Y).all(1)
+        return np.column_stack((X[:, 0], Y[:, 0], X[:, 1], Y[:, 1]))[finite].astype(int)
+    
+    def line_mask(self, shape, lines, width=_line_width):
+        """ Mask of the lines, e.g. grating edges given by hough_lines. All
+            the lines are rasterized at once, then widened.
+        
+        Returns:
+        bool ndarray of shape, True on the lines.
+        """
+        mask = np.zeros(shape, bool)
+        lines = np.asarray(lines, float).reshape(-1, 4)
+        if not len(lines):
+            return mask
+        x_a, y_a, x_b, y_b = lines.T
+        n = (np.maximum(np.abs(x_b-x_a), np.abs(y_b-y_a))+1).astype(int)
+        t = np.arange(n.sum())-np.repeat(np.cumsum(n)-n, n) # index along each line
+        t = t/np.repeat(np.maximum(n-1, 1), n)
+        xs = np.round(np.repeat(x_a, n)+t*np.repeat(x_b-x_a, n)).astype(int)
+        ys = np.round(np.repeat(y_a, n)+t*np.repeat(y_b-y_a, n)).astype(int)
+        inside = (xs >= 0) & (xs < shape[1]) & (ys >= 0) & (ys < shape[0])
+        mask[ys[inside], xs[inside]] = True
+        if width > 1:
+            mask = ndi.binary_dilation(mask, iterations=width//2)
+        return mask
+    
+    def line_valid(self, matrix, roi=None, lines=None):
+        """ The pixels left in the brightness regions once the hough lines
+            of the roi, found with the sigma_line and line_window params, are
+            masked out. None if lines are not masked or none is found.
+        
+        Keyword arguments:
+        lines -- (x1, y1, x2, y2) lines already found in the roi, e.g. the
+            ones painted by the gui. If None, they are found here.
+        """
+        if not self.params['mask_lines']:
+            return None
+        if lines is None:
+            edges, x1, y1 = self.edges(matrix, self.params['sigma_line'], roi)
+            if edges is None:
+                return None
+            lines = self.hough_lines(edges, x1, y1)
+        if not len(lines):
+            return None
+        return ~self.line_mask(matrix.shape, lines)
+    
+    def mask_integral(self, matrix, roi=None, integral=None, lines=None):
+        """ The valid mask of line_valid and the integral images of the
+            matrix under it. integral, the integral images of the whole
+            matrix, is reused if no line is masked.
+        
+        Returns:
+        valid, integral -- valid is None if no line is masked.
+        """
+        valid = self.line_valid(matrix, roi, lines)
+        if valid is not None:
+            return valid, self.integral(matrix, valid)
+        return None, self.integral(matrix) if integral is None else integral
+    
+    def empty_result(self):
+        return {'inner_b': None,
+                'inner_rect': (0, 0, 0, 0),
+                'outer_bs': [],
+                'outer_rects': [],
+                'edge_points': np.zeros((0, 2), int),
+                'reflectivity': None}
+    
+    def analyze_edges(self, edges, integral, x1=0, y1=0, matrix=None, valid=None):
+        """ Locate the pattern described by the edges, then optimize the
+            inner and outer squares around it.
+        
+        Keyword arguments:
+        edges -- bool ndarray, the edge map of the roi, could be None.
+        integral -- integral images of the whole matrix.
+        x1, y1 -- position of the roi in the matrix.
+        matrix -- the whole matrix, needed by the annulus outer method.
+        valid -- bool ndarray, the pixels left in the brightness regions, the
+            integral images must have been computed with it.
+        
+        Returns:
+        dict with inner_b, inner_rect, outer_bs, outer_rects, edge_points
+        and reflectivity.
+        """
+        result = self.empty_result()
+        if edges is None:
+            return result
+        p = self.params
+        y, x = np.nonzero(edges)
+        if len(x):
+            result['edge_points'] = np.column_stack((x1+x, y1+y))
+            xc, yc, d_min, d_max = self.pattern_geometry(x, y)
+            result['inner_b'], result['inner_rect'] = self.inner_optimizer(
+                    integral, x1, y1, xc, yc, d_min, p['inner_std'], p['inner_factor'])
+            if (p['outer_method'] == 'annulus') and (matrix is not None):
+                result['outer_bs'], result['outer_rects'] = self.annulus_optimizer(
+                        matrix, x1, y1, xc, yc, d_max, p['outer_std'], p['outer_n'], valid)
+            else:
+                result['outer_bs'], result['outer_rects'] = self.outer_optimizer(
+                        integral, x1, y1, xc, yc, d_max, p['outer_std'],
+                        p['outer_factor'], p['outer_n'])
+            result['reflectivity'] = self.cal_reflectivity(result['inner_b'],
+                    result['outer_bs'])
+        return result
+    
+    def analyze_rois(self, matrix, rois, sigma, integral=None):
+        """ Analyze several rois of one frame in one pass. The edge map and
+            the integral images are computed once for the whole frame and
+            shared by all rois.
+        
+        Returns:
+        list of result dicts, see analyze_edges.
+        """
+        edges = self.canny(matrix, sigma)
+        valid = None
+        for roi in rois:
+            roi_valid = self.line_valid(matrix, roi)
+            if roi_valid is not None:
+                valid = roi_valid if valid is None else valid & roi_valid
+        if valid is not None:
+            integral = self.integral(matrix, valid)
+        elif integral is None:
+            integral = self.integral(matrix)
+        results = []
+        for x1, y1, w, h in rois:
+            part = edges[y1:y1+h, x1:x1+w]
+            results.append(self.analyze_edges(part if part.size else None,
+                    integral, x1, y1, matrix, valid))
+        return results
+    
+    def match_background(self, image, info):
+        """ Full name of the first background image matching the image, ''
+            if there is none.
+        """
+        path, filename = os.path.split(image)
+        suffix = None if self.is_stack(image) else os.path.splitext(filename)[1]
+        bgs = self.find_backgrounds(path, info, suffix)
+        return os.path.join(path, bgs[0]) if bgs else ''
+    
+    def cache_key(self, image, background, page, roi, sigma, kind='analysis'):
+        if self.cache is None:
+            return None
+        return self.cache.key(image, background, page, roi, sigma, self.params, kind)
+    
+    def cache_get(self, key):
+        return self.cache.get(key) if key else None
+    
+    def cache_put(self, key, result, edge_points=False):
+        """ Cache the result, without its edge points unless asked: only
+            the gui draws them, and they are most of its size.
+        """
+        if key:
+            if isinstance(result, dict) and not edge_points:
+                result = {k: v for k, v in result.items() if k != 'edge_points'}
+            self.cache.put(key, result)
+    
+    def analyze_matrix(self, matrix, roi=None, sigma=0.0, integral=None, masked=None):
+        """ Analyze the roi of the matrix, with the lines masked out if the
+            mask_lines param is set. integral, the integral images of the
+            matrix, is computed if None. masked, the (valid, integral) pair
+            of mask_integral, is computed if None; the gui passes the one
+            of its current lines.
+        """
+        if masked is None:
+            masked = self.mask_integral(matrix, roi, integral)
+        valid, integral = masked
+        edges, x1, y1 = self.edges(matrix, sigma, roi)
+        return self.analyze_edges(edges, integral, x1, y1, matrix, valid)
+    
+    def benchmark_outer(self, matrix, roi=None, sigma=0.0, repeat=10):
+        """ Time the outer methods on one frame, edges and integral images
+            excluded.
+        
+        Returns:
+        dict {method: (seconds per analysis, reflectivity)}.
+        """
+        edges, x1, y1 = self.edges(matrix, sigma, roi)
+        valid = self.line_valid(matrix, roi)
+        integral = self.integral(matrix, valid)
+        method = self.params['outer_method']
+        timings = {}
+        try:
+            for outer_method in ['squares', 'annulus']:
+                self.params['outer_method'] = outer_method
+                start = time.perf_counter()
+                for i in range(repeat):
+                    result = self.analyze_edges(edges, integral, x1, y1, matrix, valid)
+                timings[outer_method] = ((time.perf_counter()-start)/repeat,
+                        result['reflectivity'])
+        finally:
+            self.params['outer_method'] = method
+        return timings
+    
+    def analyze_gray(self, matrix, roi=None, sigma=0.0):
+        """ analyze_matrix, with the sigma chosen by auto_sigma if it is
+            None, and the roi found by locate_pattern if it is 'auto'. The
+            sigma and the roi used are added to the result.
+        """
+        if roi == 'auto':
+            roi = self.locate_pattern(matrix)
+        if sigma is None:
+            sigma = self.auto_sigma(matrix, roi)[0]
+        result = self.analyze_matrix(matrix, roi, sigma)
+        result['sigma'] = sigma
+        result['roi'] = roi
+        return result
+    
+    def sigma_scan(self, matrix, sigmas, roi=None, integral=None):
+        """ Reflectivity for each sigma, in one call. The roi crop and the
+            integral images are shared by all sigmas, only the edges are
+            computed for each.
+        
+        Returns:
+        list of reflectivities, None where the analysis fails.
+        """
+        valid = self.line_valid(matrix, roi)
+        if valid is not None:
+            integral = self.integral(matrix, valid)
+        elif integral is None:
+            integral = self.integral(matrix)
+        values = []
+        for sigma in sigmas:
+            edges, x1, y1 = self.edges(matrix, sigma, roi)
+            values.append(self.analyze_edges(edges, integral, x1, y1,
+                    matrix, valid)['reflectivity'])
+        return values
+    
+    def plateau(self, sigmas, values, tol=_plateau_tol):
+        """ Center of the widest run of sigmas over which the reflectivity
+            changes by less than tol (relative) from one sigma to the next.
+            Ties go to the smaller sigmas. None if there is no such run.
+        """
+        best = (0, None)
+        start = None
+        for i in range(1, len(values)+1):
+            stable = i < len(values) and values[i] and values[i-1] and \
+                    abs(values[i]-values[i-1]) <= tol*abs(values[i-1])
+            if stable:
+                if start is None:
+                    start = i-1
+            elif start is not None:
+                if i-start > best[0]:
+                    best = (i-start, sigmas[(start+i-1)//2])
+                start = None
+        return best[1]
+    
+    def auto_sigma(self, matrix, roi=None, sigmas=_sigmas, integral=None):
+        """ Pick the sigma in the middle of the widest reflectivity plateau,
+            the smallest sigma giving a reflectivity if there is no plateau.
+        
+        Returns:
+        float sigma, list of reflectivities over sigmas.
+        """
+        sigmas = [float(sigma) for sigma in sigmas]
+        values = self.sigma_scan(matrix, sigmas, roi, integral)
+        sigma = self.plateau(sigmas, values)
+        if sigma is None:
+            sigma = next((s for s, v in zip(sigmas, values) if v), 0.0)
+        return sigma, values
+    
+    def analyze_frame(self, image, roi=None, sigma=0.0, cal_data=None, background=True):
+        """ Everything the gui does for one image, without the gui.
+        
+        Keyword arguments:
+        image -- image fullname.
+        roi -- native (x, y, w, h) roi, None for the whole frame, 'auto' to
+            locate the pattern in the frame, see locate_pattern.
+        sigma -- canny sigma.
+        cal_data -- calibration data, see get_cal_data.
+        background -- if True, subtract the matching background image.
+        
+        Returns:
+        result dict, see analyze_edges, updated with the parsed info and
+        the image, roi and background used.
+        """
+        name = os.path.splitext(os.path.basename(image))[0]
+        info = self.parse_name(name, cal_data)
+        bg = self.match_background(image, info) if (background and cal_data) else ''
+        key = self.cache_key(image, bg, None, roi, sigma)
+        result = self.cache_get(key)
+        if result is None:
+            result = self.analyze_gray(self.load_gray(image, bg), roi, sigma)
+            self.cache_put(key, result)
+        result.update(info)
+        result.update({'image': image, 'page': None, 'background': bg})
+        return result
+    
+    def analyze_page(self, stack, page, roi=None, sigma=0.0, cal_data=None, background=True):
+        """ Same as analyze_frame, for one page of a multi-page image: only
+            that page is read. A single-page image is analyzed as a frame.
+        """
+        if not self.is_stack(stack):
+            return self.analyze_frame(stack, roi, sigma, cal_data, background)
+        name = os.path.splitext(os.path.basename(stack))[0]
+        info = self.page_info(name, page, cal_data)
+        bg = self.match_background(stack, info) if (background and cal_data) else ''
+        key = self.cache_key(stack, bg, page, roi, sigma)
+        result = self.cache_get(key)
+        if result is None:
+            result = self.analyze_gray(self.load_gray(stack, bg, page), roi, sigma)
+            self.cache_put(key, result)
+        result.update(info)
+        result.update({'image': stack, 'page': page, 'background': bg})
+        return result
+    
+    def analyze_stack(self, stack, roi=None, sigma=0.0, cal_data=None, background=True):
+        """ Same as analyze_frame, for each page of a multi-page image. This
+            is a generator, pages are read and analyzed one at a time. A
+            single-page image is analyzed as a frame.
+        """
+        if not self.is_stack(stack):
+            yield self.analyze_frame(stack, roi, sigma, cal_data, background)
+            return
+        name = os.path.splitext(os.path.basename(stack))[0]
+        bgs = {}
+        for page, gray in self.iter_pages(stack):
+            info = self.page_info(name, page, cal_data)
+            bg = ''
+            if background and cal_data:
+                key = (info['exposure'], info['gain'], info['polarization'])
+                if key not in bgs:
+                    bgs[key] = self.match_background(stack, info)
+                bg = bgs[key]
+            cache_key = self.cache_key(stack, bg, page, roi, sigma)
+            result = self.cache_get(cache_key)
+            if result is None:
+                result = self.analyze_gray(self.subtract_dark(gray, bg), roi, sigma)
+                self.cache_put(cache_key, result)
+            result.update(info)
+            result.update({'image': stack, 'page': page, 'background': bg})
+            yield result
+
+
+class SpectralCube(object):
+    """ A whole wavelength series stacked into one memory-mapped
+        (wavelength, y, x) cube, so that the brightness of fixed squares
+        can be computed for all the frames at once.
+    """
+    def __init__(self, engine, images, cal_data=None, background=True):
+        self.engine = engine
+        self.images = [] # images stacked in the cube, in order
+        self.pages = [] # page of each stacked image, None if not a stack
+        self.infos = [] # parsed info of each stacked image
+        self.filename = '' # file backing the cube
+        self.cube = None
+        self.load(images, cal_data, background)
+    
+    def load(self, images, cal_data=None, background=True):
+        """ Stack the images, multi-page images page by page. """
+        frames = []
+        for image in images:
+            name = os.path.splitext(os.path.basename(image))[0]
+            try:
+                if self.engine.is_stack(image):
+                    infos = [(page, self.engine.page_info(name, page, cal_data)) \
+                            for page in range(self.engine.count_pages(image))]
+                else:
+                    infos = [(None, self.engine.parse_name(name, cal_data))]
+            except:
+                continue
+            frames.extend((image, page, info) for page, info in infos if info['wavelength'])
+        cube = None
+        k = 0
+        for image, page, info in frames:
+            try:
+                bg = ''
+                if background and cal_data:
+                    bg = self.engine.match_background(image, info)
+                gray = self.engine.load_gray(image, bg, page)
+            except:
+                continue
+            if cube is None:
+                fd, self.filename = tempfile.mkstemp(suffix='.cube')
+                os.close(fd)
+                cube = np.memmap(self.filename, np.uint8, 'w+',
+                        shape=(len(frames),)+gray.shape)
+            elif gray.shape != cube.shape[1:]:
+                continue
+            cube[k] = gray
+            self.images.append(image)
+            self.pages.append(page)
+            self.infos.append(info)
+            k += 1
+        self.cube = cube[:k] if cube is not None else np.zeros((0, 0, 0), np.uint8)
+    
+    def close(self):
+        self.cube = None
+        if self.filename and os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.filename = ''
+    
+    def block_means(self, rect, valid=None):
+        """ Mean of the (x, y, w, h) block in every frame, None if empty.
+            Only the valid pixels count, if a mask is given.
+        """
+        x, y, w, h = rect
+        block = self.cube[:, y:y+h, x:x+w]
+        if valid is not None:
+            block = block[:, valid[y:y+h, x:x+w]]
+        if not block.size:
+            return None
+        return block.reshape(len(block), -1).mean(axis=1)
+    
+    def reflectivity(self, inner_rect, outer_rects, valid=None):
+        """ Reflectivity of every frame, using the same inner and outer
+            squares for all of them, see NPCEngine.cal_reflectivity.
+            valid masks the lines out, see NPCEngine.line_valid.
+        
+        Returns:
+        ndarray, None if the squares are empty.
+        """
+        inner = self.block_means(inner_rect, valid)
+        outers = [self.block_means(rect, valid) for rect in outer_rects]
+        outers = [outer for outer in outers if outer is not None]
+        if (inner is None) or (not outers):
+            return None
+        return inner/np.mean(outers, axis=0)
+
+
+def to_float(text, default=np.nan):
+    try:
+        return float(text)
+    except:
+        return default
+
+
+def file_hash(fullname):
+    """ sha1 of the file content, read in chunks. """
+    sha = hashlib.sha1()
+    with open(fullname, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ResultCache(object):
+    """ Persistent analysis results, addressed by what they are computed
+        from: frame and background content, page, roi, sigma, optimizer
+        parameters and the version of the algorithms. Once the cache grows
+        over max_size bytes, the least recently used results are evicted.
+        The use times of the hits are kept in memory and written at most
+        every _cache_touch seconds, lookups don't sync the disk.
+    """
+    def __init__(self, filename=_cache_file, max_size=_cache_size):
+        self.filename = filename
+        self.max_size = max_size
+        self.hashes = {} # file hashes, keyed by (fullname, mtime, size)
+        self.touched = {} # use times of the hits not written yet, keyed by key
+        self.written = time.time() # when the use times were last written
+        path = os.path.dirname(filename)
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+        self.conn = sqlite3.connect(filename, timeout=30)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results '
+                '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+        self.conn.commit()
+    
+    def file_hash(self, fullname):
+        stat = os.stat(fullname)
+        key = (fullname, stat.st_mtime, stat.st_size)
+        if key not in self.hashes:
+            self.hashes[key] = file_hash(fullname)
+        return self.hashes[key]
+    
+    def key(self, image, background, page, roi, sigma, params, kind='analysis'):
+        if roi != 'auto':
+            roi = tuple(int(v) for v in roi) if roi else None
+        parts = [str(_cache_version),
+                 kind,
+                 self.file_hash(image),
+                 self.file_hash(background) if background else '',
+                 repr(page),
+                 repr(roi),
+                 'auto' if sigma is None else '{0:.6f}'.format(sigma),
+                 repr(sorted(params.items()))]
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+    
+    def get(self, key):
+        row = self.conn.execute('SELECT value FROM results WHERE key=?',
+                (key,)).fetchone()
+        if row is None:
+            return None
+        self.touched[key] = time.time()
+        if self.touched[key]-self.written > _cache_touch:
+            self.touch()
+            self.conn.commit()
+        return pickle.loads(zlib.decompress(row[0]))
+    
+    def touch(self):
+        """ Write the use times of the recent hits, uncommitted. """
+        self.conn.executemany('UPDATE results SET used=? WHERE key=?',
+                [(used, key) for key, used in self.touched.items()])
+        self.touched.clear()
+        self.written = time.time()
+    
+    def put(self, key, result):
+        value = zlib.compress(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        self.conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                (key, sqlite3.Binary(value), len(value), time.time()))
+        self.touch()
+        self.evict()
+        self.conn.commit()
+    
+    def evict(self):
+        """ Drop the least recently used results until the cache is back to
+            90% of max_size, so that eviction doesn't run on every put.
+        """
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_size:
+            return
+        excess = total-0.9*self.max_size
+        keys = []
+        for key, size in self.conn.execute('SELECT key, size FROM results ORDER BY used'):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.conn.executemany('DELETE FROM results WHERE key=?', keys)
+    
+    def clear(self):
+        self.conn.execute('DELETE FROM results')
+        self.conn.commit()
+
+
+class ResultStore(object):
+    """ Append-only store of all the data points ever taken. Each point keeps
+        where it comes from (frame, page, roi, sigmas, background, optimizer
+        parameters) and the session it was taken in, so measurements can be
+        queried and merged across sessions without parsing text exports.
+    """
+    columns = ['session', 'time', 'wavelength', 'reflectivity', 'polarization',
+               'fwhm', 'image', 'page', 'roi', 'sigma', 'sigma_line',
+               'background', 'params']
+    
+    def __init__(self, filename=_store_file):
+        self.filename = filename
+        path = os.path.dirname(filename)
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+        self.conn = sqlite3.connect(filename, timeout=30)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS points '
+                '(id INTEGER PRIMARY KEY, session TEXT, time REAL, wavelength REAL, '
+                'reflectivity REAL, polarization TEXT, fwhm REAL, image TEXT, '
+                'page INTEGER, roi TEXT, sigma REAL, sigma_line REAL, '
+                'background INTEGER, params TEXT)')
+        for column in ['wavelength', 'polarization', 'fwhm', 'image', 'params', 'session']:
+            self.conn.execute('CREATE INDEX IF NOT EXISTS points_{0} ON points ({0})'.format(column))
+        self.conn.commit()
+    
+    def append(self, points):
+        """ Append data points, given as dicts with the store columns. The
+            missing columns are left empty.
+        
+        Returns:
+        list of the ids given to the points.
+        """
+        ids = []
+        for point in points:
+            point = dict(point)
+            for key in ['wavelength', 'reflectivity', 'fwhm']:
+                point[key] = to_float(point.get(key), None)
+            roi = point.get('roi')
+            point['roi'] = ','.join(str(int(v)) for v in roi) if roi else ''
+            params = point.get('params')
+            point['params'] = repr(sorted(params.items())) if params else ''
+            point.setdefault('time', time.time())
+            values = [point.get(key) for key in self.columns]
+            cursor = self.conn.execute('INSERT INTO points ({0}) VALUES ({1})'.format(
+                    ', '.join(self.columns), ', '.join('?'*len(self.columns))), values)
+            ids.append(cursor.lastrowid)
+        self.conn.commit()
+        return ids
+    
+    def where(self, session=None, polarization=None, wavelength=None, image=None):
+        """ SQL condition and arguments for the query filters. wavelength is
+            a (min, max) range.
+        """
+        conds = []
+        args = []
+        if session is not None:
+            conds.append('session=?')
+            args.append(session)
+        if polarization is not None:
+            conds.append('polarization=?')
+            args.append(polarization)
+        if wavelength is not None:
+            conds.append('wavelength BETWEEN ? AND ?')
+            args.extend(wavelength)
+        if image is not None:
+            conds.append('image=?')
+            args.append(image)
+        return (' WHERE '+' AND '.join(conds) if conds else ''), args
+    
+    def count(self, **filters):
+        where, args = self.where(**filters)
+        return self.conn.execute('SELECT COUNT(*) FROM points'+where, args).fetchone()[0]
+    
+    def query(self, offset=0, limit=_page_size, **filters):
+        """ One page of points, in the order they were taken.
+        
+        Returns:
+        list of dicts with id and the store columns, roi as a tuple or None.
+        """
+        where, args = self.where(**filters)
+        rows = self.conn.execute('SELECT id, {0} FROM points{1} ORDER BY id '
+                'LIMIT ? OFFSET ?'.format(', '.join(self.columns), where),
+                args+[limit, offset])
+        points = []
+        for row in rows:
+            point = dict(zip(['id']+self.columns, row))
+            roi = point['roi']
+            point['roi'] = tuple(int(v) for v in roi.split(',')) if roi else None
+            points.append(point)
+        return points
+    
+    def sessions(self):
+        rows = self.conn.execute('SELECT session, COUNT(*), MIN(time) FROM points '
+                'GROUP BY session ORDER BY MIN(time)')
+        return [(session, n) for session, n, t in rows]
+    
+    def merge(self, **filters):
+        """ All the matching points sorted by wavelength and split by
+            polarization, like BatchRunner.merge.
+        
+        Returns:
+        dict of (n, 2) ndarrays [wavelength, reflectivity%].
+        """
+        where, args = self.where(**filters)
+        where += (' AND ' if where else ' WHERE ')+'wavelength IS NOT NULL'
+        rows = self.conn.execute('SELECT polarization, wavelength, reflectivity '
+                'FROM points'+where+' ORDER BY wavelength', args)
+        data_dict = {}
+        for polarization, wavelength, reflectivity in rows:
+            data_dict.setdefault(polarization or 'unknown', []).append(
+                    [wavelength, reflectivity])
+        return {key: np.array(value) for key, value in data_dict.items()}
+    
+    def close(self):
+        self.conn.close()
+
+
+class Exporter(object):
+    """ Write table columns, as given by MyDataTable.get_columns, to CSV,
+        npz or HDF5. Rows are written chunk by chunk, so it can run on a
+        worker while the table keeps changing.
+    """
+    def __init__(self, precision=4, chunk=_export_chunk):
+        self.precision = precision
+        self.chunk = chunk
+    
+    def write(self, fullname, columns, params=None):
+        suffix = os.path.splitext(fullname)[1].lower()
+        if suffix == '.csv':
+            self.write_csv(fullname, columns)
+        elif suffix == '.npz':
+            self.write_npz(fullname, columns, params)
+        elif suffix in ['.h5', '.hdf5']:
+            self.write_hdf5(fullname, columns, params)
+        else:
+            raise ValueError('Unknown export format: {0}'.format(suffix))
+        return fullname
+    
+    def format_column(self, values):
+        """ Column as a list of strings, nan as empty fields. """
+        if values.dtype.kind != 'f':
+            return values.astype(str).tolist()
+        fmt = '{{0:.{0}f}}'.format(self.precision)
+        return ['' if np.isnan(v) else fmt.format(v) for v in values.tolist()]
+    
+    def write_csv(self, fullname, columns):
+        keys = list(columns.keys())
+        n = len(columns[keys[0]]) if keys else 0
+        with open(fullname, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(keys)
+            for i in range(0, n, self.chunk):
+                part = [self.format_column(columns[key][i:i+self.chunk]) for key in keys]
+                writer.writerows(zip(*part))
+    
+    def write_npz(self, fullname, columns, params=None):
+        arrays = dict(columns)
+        if params:
+            arrays['params'] = np.array(repr(sorted(params.items())))
+        with open(fullname, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+    
+    def write_hdf5(self, fullname, columns, params=None):
+        """ One group per polarization holding one dataset per column, the
+            optimizer parameters are attributes of the file.
+        """
+        if h5py is None:
+            raise ImportError('h5py is needed to export HDF5 files')
+        polars = columns['polarization']
+        with h5py.File(fullname, 'w') as f:
+            for key, value in (params or {}).items():
+                f.attrs[key] = value
+            for polar in np.unique(polars):
+                mask = (polars == polar)
+                group = f.create_group('polarization_{0}'.format(polar or 'unknown'))
+                n = int(mask.sum())
+                for key, values in columns.items():
+                    if key == 'polarization':
+                        continue
+                    values = values[mask]
+                    if values.dtype.kind == 'U':
+                        dset = group.create_dataset(key, (n,), h5py.special_dtype(vlen=str))
+                    else:
+                        dset = group.create_dataset(key, (n,), values.dtype,
+                                chunks=(min(max(n, 1), self.chunk),))
+                    for i in range(0, n, self.chunk):
+                        dset[i:i+self.chunk] = values[i:i+self.chunk]
+
+
+class SharedArrays(object):
+    """ Arrays placed once in shared memory by the parent process, so that
+        the workers of a pool attach them without copy, see attach_arrays.
+    """
+    def __init__(self):
+        self.blocks = {} # SharedMemory blocks, keyed like the arrays
+        self.specs = {} # (block name, shape, dtype) of the arrays, sent to the workers
+    
+    def share(self, key, array):
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        self.blocks[key] = block
+        self.specs[key] = (block.name, array.shape, array.dtype.str)
+    
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+        self.specs = {}
+
+
+_shared_blocks = {} # blocks attached by a worker process, kept open while it lives
+
+
+def attach_arrays(specs):
+    """ Read-only views on the arrays shared by SharedArrays. """
+    arrays = {}
+    for key, (name, shape, dtype) in specs.items():
+        if name not in _shared_blocks:
+            _shared_blocks[name] = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype, buffer=_shared_blocks[name].buf)
+        array.flags.writeable = False
+        arrays[key] = array
+    return arrays
+
+
+def _analyze_group(turn, images, cal_data, roi, sigma, params, background, cache=None,
+        darks=None):
+    """ Batch job analyzing all the images of one polarization turn with a
+        single engine, so that the calibration slice and the backgrounds of
+        that turn stay resident in the worker. darks are the specs of the
+        backgrounds in shared memory, see SharedArrays.
+    """
+    engine = NPCEngine(params, threads=1)
+    if darks:
+        engine.darks.update(attach_arrays(darks))
+    if cache:
+        engine.cache = ResultCache(cache)
+    results = []
+    for image in images:
+        try:
+            if engine.is_stack(image):
+                group = list(engine.analyze_stack(image, roi, sigma, cal_data, background))
+            else:
+                group = [engine.analyze_frame(image, roi, sigma, cal_data, background)]
+        except:
+            continue
+        for result in group:
+            result.pop('edge_points', None)
+            results.append(result)
+    return turn, results
+
+
+class BatchRunner(object):
+    """ Analyze many images on a process pool. Images are grouped by their
+        polarization turn (see _filter) and each group goes to its own
+        worker, in wavelength order.
+    """
+    def __init__(self, params=None, workers=None, cache=None):
+        self.engine = NPCEngine(params)
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache # ResultCache filename shared by the workers
+    
+    def group(self, images):
+        """ Sort the images by polarization turn and wavelength. Images
+            whose name can't be parsed are left out.
+        
+        Returns:
+        dict {turn: image list}.
+        """
+        groups = {}
+        for image in images:
+            name = os.path.splitext(os.path.basename(image))[0]
+            if self.engine.is_stack(image):
+                peak, turn = 0.0, self.engine.parse_stack_turn(name)
+            else:
+                try:
+                    peak, turn = self.engine.parse_turn(name)
+                except ValueError:
+                    continue
+            if turn in _filter:
+                groups.setdefault(turn, []).append((peak, image))
+        return {turn: [image for peak, image in sorted(group)] \
+                for turn, group in groups.items()}
+    
+    def backgrounds(self, images, cal_data):
+        """ Full names of the backgrounds matching the images, each read
+            once by the parent and shared with the workers.
+        """
+        bgs = set()
+        seen = set()
+        for image in images:
+            name = os.path.splitext(os.path.basename(image))[0]
+            try:
+                if self.engine.is_stack(image):
+                    infos = [self.engine.page_info(name, page, cal_data) \
+                            for page in range(self.engine.count_pages(image))]
+                else:
+                    infos = [self.engine.parse_name(name, cal_data)]
+            except:
+                continue
+            for info in infos:
+                suffix = None if self.engine.is_stack(image) else os.path.splitext(image)[1]
+                key = (os.path.dirname(image), suffix, info['exposure'], info['gain'], info['polarization'])
+                if key not in seen:
+                    seen.add(key)
+                    bg = self.engine.match_background(image, info)
+                    if bg:
+                        bgs.add(bg)
+        return bgs
+    
+    def cal_slice(self, cal_data, turn):
+        """ The calibration data with only the blocks of the turn left, the
+            block indices are kept so that parse_name still works.
+        """
+        if not cal_data:
+            return None
+        return [block if i in _filter[turn] else [] for i, block in enumerate(cal_data)]
+    
+    def run(self, images, roi=None, sigma=0.0, cal_data=None, background=True):
+        """ Analyze the images, see NPCEngine.analyze_frame.
+        
+        Returns:
+        list of result dicts, grouped by polarization turn.
+        """
+        groups = self.group(images)
+        if not groups:
+            return []
+        results = {}
+        workers = min(len(groups), self.workers)
+        shared = SharedArrays()
+        try:
+            if background and cal_data:
+                for bg in self.backgrounds(images, cal_data):
+                    shared.share((bg, os.path.getmtime(bg)), self.engine.get_dark(bg))
+                self.engine.darks.clear()
+            with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                jobs = [pool.submit(_analyze_group, turn, group,
+                        self.cal_slice(cal_data, turn), roi, sigma,
+                        self.engine.params, background, self.cache, shared.specs) \
+                        for turn, group in groups.items()]
+                for job in futures.as_completed(jobs):
+                    turn, group_results = job.result()
+                    results[turn] = group_results
+        finally:
+            shared.close()
+        return [result for turn in sorted(results) for result in results[turn]]
+    
+    def merge(self, results):
+        """ Merge the results into per-polarization spectra, in the same
+            layout as the data_dict of MyDataTable.get_data.
+        
+        Returns:
+        dict {polarization: (n, 2) ndarray of wavelength and reflectivity [%]}.
+        """
+        spectra = {}
+        for result in results:
+            if result['reflectivity'] and result['wavelength']:
+                key = result['polarization'] or 'unknown'
+                spectra.setdefault(key, []).append([float(result['wavelength']),
+                        100*result['reflectivity']])
+        data_dict = {}
+        for key, spectrum in spectra.items():
+            spectrum = np.array(spectrum)
+            data_dict[key] = spectrum[spectrum[:, 0].argsort()]
+        return data_dict
+
+
+class Campaign(object):
+    """ Analyze a campaign of directories on several nodes sharing storage,
+        without any scheduler. Nodes claim directories by creating claim
+        files exclusively in the output directory, analyze them with a local
+        BatchRunner and write one partial results file per directory. merge
+        then combines the partial files, whoever wrote them. A working node
+        keeps touching its claim, the claims left by dead nodes go stale and
+        are removed by release.
+    """
+    def __init__(self, directories, output, suffix=None, roi=None, sigma=0.0,
+            background=True, params=None, workers=None):
+        self.directories = sorted(directories)
+        self.output = output
+        self.suffix = suffix # image format, None for all of _formats
+        self.roi = roi
+        self.sigma = sigma
+        self.background = background
+        self.params = params
+        self.workers = workers
+    
+    def key(self, directory):
+        return hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()
+    
+    def partial_name(self, directory):
+        return os.path.join(self.output, self.key(directory)+'.npz')
+    
+    def claim_name(self, directory):
+        return os.path.join(self.output, self.key(directory)+'.claim')
+    
+    def claim(self, directory, node):
+        """ Try to take the directory for the node, True if it is ours. """
+        claim = self.claim_name(directory)
+        try:
+            fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write('{0}\n{1}\n'.format(node, directory))
+        return True
+    
+    def heartbeat(self, claim, stop):
+        """ Touch the claim until stop is set, so that it never looks stale
+            while the directory is analyzed.
+        """
+        while not stop.wait(_claim_heartbeat):
+            try:
+                os.utime(claim)
+            except OSError:
+                pass
+    
+    def release(self, timeout=_claim_timeout):
+        """ Remove the stale claims of the directories without partial file,
+            i.e. not touched for timeout seconds because their node died, so
+            that the next run picks them up again. The claims of the nodes
+            still working are kept.
+        
+        Returns:
+        list of the directories released.
+        """
+        released = []
+        now = time.time()
+        for directory in self.directories:
+            claim = self.claim_name(directory)
+            try:
+                if os.path.exists(self.partial_name(directory)) or \
+                        now-os.path.getmtime(claim) < timeout:
+                    continue
+                os.remove(claim)
+            except OSError:
+                continue
+            released.append(directory)
+        return released
+    
+    def images(self, directory):
+        formats = [self.suffix] if self.suffix else _formats
+        return [os.path.join(directory, f) for f in sorted(os.listdir(directory)) \
+                if os.path.splitext(f)[1] in formats]
+    
+    def analyze(self, directory):
+        """ Analyze one directory with its calibration file, if any.
+        
+        Returns:
+        dict of columns, see write_partial.
+        """
+        engine = NPCEngine(self.params)
+        cals = sorted(f for f in os.listdir(directory) \
+                if os.path.splitext(f)[1] == _cal_format)
+        cal_data = engine.get_cal_data(os.path.join(directory, cals[0])) if cals else None
+        runner = BatchRunner(self.params, self.workers)
+        results = runner.run(self.images(directory), self.roi, self.sigma,
+                cal_data, self.background)
+        results = [r for r in results if r['reflectivity'] and r['wavelength']]
+        hashes = {}
+        for r in results:
+            if r['image'] not in hashes:
+                hashes[r['image']] = file_hash(r['image'])
+        return {'hash': np.array(['{0}:{1}'.format(hashes[r['image']], r['page'] or 0) \
+                        for r in results], dtype=str),
+                'wavelength': np.array([to_float(r['wavelength']) for r in results], float),
+                'reflectivity': np.array([100*r['reflectivity'] for r in results], float),
+                'polarization': np.array([r['polarization'] or 'unknown' for r in results],
+                        dtype=str),
+                'fwhm': np.array([to_float(r['FWHM']) for r in results], float),
+                'image': np.array([r['image'] for r in results], dtype=str),
+                'page': np.array([r['page'] or 0 for r in results], int)}
+    
+    def write_partial(self, directory, columns):
+        """ Write the partial file under a temporary name first, so that a
+            partial file is always complete.
+        """
+        fullname = self.partial_name(directory)
+        temp = '{0}.{1}.tmp'.format(fullname, os.getpid())
+        with open(temp, 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(temp, fullname)
+    
+    def node(self, node=None):
+        """ Run one node: claim and analyze directories until none is left.
+        
+        Returns:
+        list of the directories analyzed by this node.
+        """
+        node = node or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        if not os.path.isdir(self.output):
+            os.makedirs(self.output, exist_ok=True)
+        done = []
+        for directory in self.directories:
+            if os.path.exists(self.partial_name(directory)) or \
+                    not self.claim(directory, node):
+                continue
+            claim = self.claim_name(directory)
+            stop = threading.Event()
+            beat = threading.Thread(target=self.heartbeat, args=(claim, stop), daemon=True)
+            beat.start()
+            try:
+                self.write_partial(directory, self.analyze(directory))
+            except:
+                # give the directory back, another node or run retries it
+                traceback.print_exc()
+                try:
+                    os.remove(claim)
+                except OSError:
+                    pass
+                continue
+            finally:
+                stop.set()
+                beat.join()
+            done.append(directory)
+        return done
+    
+    def run_local(self, nodes=2):
+        """ Stand several local processes in for the nodes. """
+        procs = [multiprocessing.Process(target=self.node, args=('local-{0}'.format(i),)) \
+                for i in range(nodes)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+    
+    def merge(self):
+        """ Combine the partial files. A frame found more than once, e.g. a
+            directory copied into another one, is counted once. Frames of
+            the same wavelength and polarization are averaged.
+        
+        Returns:
+        dict of columns sorted by polarization and wavelength: polarization,
+        wavelength, reflectivity, reflectivity_std, n.
+        """
+        parts = []
+        for f in sorted(os.listdir(self.output)):
+            if f.endswith('.npz'):
+                with np.load(os.path.join(self.output, f)) as part:
+                    parts.append({key: part[key] for key in part.files})
+        if not parts:
+            return {}
+        hashes = np.concatenate([p['hash'] for p in parts])
+        unique = np.unique(hashes, return_index=True)[1]
+        wavelength = np.concatenate([p['wavelength'] for p in parts])[unique]
+        reflectivity = np.concatenate([p['reflectivity'] for p in parts])[unique]
+        polarization = np.concatenate([p['polarization'] for p in parts])[unique]
+        order = np.lexsort((wavelength, polarization))
+        wavelength = wavelength[order]
+        reflectivity = reflectivity[order]
+        polarization = polarization[order]
+        new = np.ones(len(order), bool)
+        new[1:] = (wavelength[1:] != wavelength[:-1]) | (polarization[1:] != polarization[:-1])
+        groups = np.cumsum(new)-1
+        n = np.bincount(groups)
+        mean = np.bincount(groups, reflectivity)/n
+        mean2 = np.bincount(groups, reflectivity**2)/n
+        return {'polarization': polarization[new],
+                'wavelength': wavelength[new],
+                'reflectivity': mean,
+                'reflectivity_std': np.sqrt(np.maximum(mean2-mean**2, 0.0)),
+                'n': n}
+
+
+def _analyze_matrix(matrix, roi, sigma, params):
+    """ Pipeline job: the CPU-bound part of NPCEngine.analyze_frame. """
+    result = NPCEngine(params, threads=1).analyze_gray(matrix, roi, sigma)
+    result.pop('edge_points', None)
+    return result
+
+
+class Pipeline(object):
+    """ Batch analysis in stages coordinated by asyncio: discovery and
+        decoding and background subtraction on a thread pool, then edges
+        and optimizers on a process pool. The stages are joined by bounded
+        queues, so the disk and the cpus are kept busy at the same time
+        without reading the whole series ahead.
+    """
+    def __init__(self, params=None, decoders=4, workers=None, depth=_pipeline_depth):
+        self.engine = NPCEngine(params)
+        self.decoders = decoders
+        self.workers = workers or os.cpu_count() or 1
+        self.depth = depth
+        self.bgs = {} # matched backgrounds, keyed by image and info
+        self.lock = threading.Lock() # guards bgs and the darks, shared by the decoders
+    
+    def decode(self, image, page, cal_data, background):
+        """ Same as update_matrix: read the frame and subtract its matching
+            background.
+        
+        Returns:
+        info dict, background fullname, gray matrix.
+        """
+        name = os.path.splitext(os.path.basename(image))[0]
+        if page is None:
+            info = self.engine.parse_name(name, cal_data)
+        else:
+            info = self.engine.page_info(name, page, cal_data)
+        bg = ''
+        if background and cal_data:
+            key = (image, info['exposure'], info['gain'], info['polarization'])
+            with self.lock:
+                if key not in self.bgs:
+                    self.bgs[key] = self.engine.match_background(image, info)
+                bg = self.bgs[key]
+                if bg:
+                    self.engine.get_dark(bg) # read once, then shared by the decoders
+        return info, bg, self.engine.load_gray(image, bg, page)
+    
+    async def discover_stage(self, loop, threads, images, items):
+        """ Expand the images into pages one at a time, see
+            NPCEngine.discover, so that decoding starts with the first one.
+        """
+        i = 0
+        for image in images:
+            try:
+                pages = await loop.run_in_executor(threads, self.engine.discover, [image])
+            except:
+                continue
+            for image, page in pages:
+                await items.put((i, image, page))
+                i += 1
+        for k in range(self.decoders):
+            await items.put(None)
+    
+    async def decode_stage(self, loop, threads, items, results, args):
+        cal_data, background = args
+        while True:
+            item = await items.get()
+            if item is None:
+                break
+            i, image, page = item
+            try:
+                decoded = await loop.run_in_executor(threads, self.decode,
+                        image, page, cal_data, background)
+            except:
+                continue
+            await results.put((i, image, page, decoded))
+    
+    async def analyze_stage(self, loop, procs, items, results, args):
+        roi, sigma = args
+        while True:
+            item = await items.get()
+            if item is None:
+                break
+            i, image, page, (info, bg, matrix) = item
+            try:
+                result = await loop.run_in_executor(procs, _analyze_matrix,
+                        matrix, roi, sigma, self.engine.params)
+            except:
+                continue
+            result.update(info)
+            result.update({'image': image, 'page': page, 'background': bg})
+            results[i] = result
+    
+    async def process(self, images, roi, sigma, cal_data, background):
+        loop = asyncio.get_event_loop()
+        decode_q = asyncio.Queue(self.depth)
+        analyze_q = asyncio.Queue(self.depth)
+        results = {}
+        with futures.ThreadPoolExecutor(self.decoders) as threads, \
+                futures.ProcessPoolExecutor(self.workers) as procs:
+            decoders = [asyncio.ensure_future(self.decode_stage(loop, threads,
+                    decode_q, analyze_q, (cal_data, background))) \
+                    for i in range(self.decoders)]
+            analyzers = [asyncio.ensure_future(self.analyze_stage(loop, procs,
+                    analyze_q, results, (roi, sigma))) for i in range(self.workers)]
+            await self.discover_stage(loop, threads, images, decode_q)
+            await asyncio.gather(*decoders)
+            for task in analyzers:
+                await analyze_q.put(None)
+            await asyncio.gather(*analyzers)
+        return [results[i] for i in sorted(results)]
+    
+    def run(self, images, roi=None, sigma=0.0, cal_data=None, background=True):
+        """ Analyze the images, see NPCEngine.analyze_frame.
+        
+        Returns:
+        list of result dicts, in the order of the images and pages.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.process(images, roi, sigma,
+                    cal_data, background))
+        finally:
+            loop.close()
+
+
+def _sweep_frame(image, page, bg, roi, grid, params):
+    """ Sweep job for one frame: the integral images are computed once, the
+        edge map once per sigma, and shared by all the optimizer settings.
+    
+    Returns:
+    list of reflectivities, in the order of the grid points.
+    """
+    engine = NPCEngine(params, threads=1)
+    matrix = engine.load_gray(image, bg, page)
+    if roi == 'auto':
+        roi = engine.locate_pattern(matrix)
+    edges = {}
+    masks = {} # (valid, integral images), keyed by the line params
+    values = []
+    for point in grid:
+        sigma = point['sigma']
+        if sigma not in edges:
+            edges[sigma] = engine.edges(matrix, sigma, roi)
+        engine.params = dict(params, **{k: v for k, v in point.items() if k != 'sigma'})
+        key = tuple(engine.params[k] for k in ['mask_lines', 'sigma_line', 'line_window'])
+        if key not in masks:
+            valid = engine.line_valid(matrix, roi)
+            masks[key] = (valid, engine.integral(matrix, valid))
+        valid, integral = masks[key]
+        e, x1, y1 = edges[sigma]
+        values.append(engine.analyze_edges(e, integral, x1, y1, matrix, valid)['reflectivity'])
+    return values
+
+
+class ParameterSweep(object):
+    """ Evaluate a grid of sigma and optimizer parameters over a set of
+        frames, to find settings the reflectivity is not sensitive to.
+    """
+    def __init__(self, params=None, workers=None):
+        self.engine = NPCEngine(params)
+        self.workers = workers or os.cpu_count() or 1
+    
+    def grid(self, values):
+        """ All the combinations of the values, a dict of lists keyed by
+            sigma and the keys of _params, missing keys keep their current
+            value.
+        """
+        values = dict(values)
+        values.setdefault('sigma', [0.0])
+        for key, value in self.engine.params.items():
+            values.setdefault(key, [value])
+        keys = sorted(values)
+        return [dict(zip(keys, point)) for point in itertools.product(
+                *[values[key] for key in keys])]
+    
+    def run(self, images, values, roi=None, cal_data=None, background=True):
+        """ Analyze every frame at every grid point, one job per frame.
+        
+        Returns:
+        dict of columns, one row per grid point sorted by deviation: the
+        parameters, mean reflectivity [%] over the frames, deviation (mean
+        relative distance of each frame to its median over the grid) and
+        failed (frames without reflectivity).
+        """
+        grid = self.grid(values)
+        items = []
+        for image, page in self.engine.discover(images):
+            name = os.path.splitext(os.path.basename(image))[0]
+            info = self.engine.parse_name(name, cal_data) if page is None \
+                    else self.engine.page_info(name, page, cal_data)
+            bg = self.engine.match_background(image, info) if (background and cal_data) else ''
+            items.append((image, page, bg))
+        with futures.ProcessPoolExecutor(self.workers) as pool:
+            jobs = [pool.submit(_sweep_frame, image, page, bg, roi, grid,
+                    self.engine.params) for image, page, bg in items]
+            table = np.array([[np.nan if v is None else v for v in job.result()] \
+                    for job in jobs], float).reshape(len(items), len(grid))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # frames failing everywhere
+            median = np.nanmedian(table, axis=1)[:, None]
+            deviation = np.nanmean(np.abs(table-median)/median, axis=0)
+            mean = 100*np.nanmean(table, axis=0)
+        order = np.argsort(deviation, kind='mergesort')
+        columns = {key: np.array([point[key] for point in grid])[order] for key in grid[0]} \
+                if grid else {}
+        columns.update({'reflectivity': mean[order],
+                        'deviation': deviation[order],
+                        'failed': np.isnan(table).sum(0)[order]})
+        return columns
+
+
+_service_engines = {} # engines of a service worker process, keyed by params
+
+
+def _analyze_request(frame, params):
+    """ Service job analyzing one frame, given as a dict with either image
+        (fullname, optionally page, cal and background) or data (base64 raw
+        buffer with shape and an integer dtype, wider ones are scaled to 8
+        bits as tiff pages), and roi and sigma.
+    
+    Returns:
+    dict with inner_b, inner_rect, outer_bs, outer_rects and reflectivity,
+    plus wavelength, polarization and FWHM for images, or error.
+    """
+    key = repr(sorted(params.items()))
+    if key not in _service_engines:
+        _service_engines[key] = NPCEngine(params, threads=1)
+    engine = _service_engines[key]
+    roi = frame.get('roi')
+    if roi != 'auto':
+        roi = tuple(int(v) for v in roi) if roi else None
+    sigma = float(frame.get('sigma', 0.0))
+    try:
+        if 'data' in frame:
+            array = np.frombuffer(base64.b64decode(frame['data']),
+                    frame.get('dtype', 'uint8')).reshape(frame['shape'])
+            if array.dtype.kind not in 'ui':
+                return {'error': 'unsupported dtype {0}, integer data only'.format(array.dtype)}
+            result = engine.analyze_gray(engine.page2gray(array), roi, sigma)
+        else:
+            cal = frame.get('cal')
+            cal_data = engine.get_cal_data(cal) if cal else None
+            background = bool(frame.get('background', True))
+            if 'page' in frame:
+                result = engine.analyze_page(frame['image'], int(frame['page']), roi, sigma,
+                        cal_data, background)
+            else:
+                result = engine.analyze_frame(frame['image'], roi, sigma, cal_data, background)
+    except:
+        return {'error': traceback.format_exc()}
+    reply = {'inner_b': result['inner_b'],
+             'inner_rect': [int(v) for v in result['inner_rect']],
+             'outer_bs': [float(b) for b in result['outer_bs']],
+             'outer_rects': [[int(v) for v in r] for r in result['outer_rects']],
+             'reflectivity': result['reflectivity'],
+             'roi': [int(v) for v in result['roi']] if result.get('roi') else None}
+    for key in ['wavelength', 'polarization', 'FWHM']:
+        if key in result:
+            reply[key] = result[key]
+    if reply['inner_b'] is not None:
+        reply['inner_b'] = float(reply['inner_b'])
+    if reply['reflectivity'] is not None:
+        reply['reflectivity'] = float(reply['reflectivity'])
+    return reply
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    """ JSON over HTTP/1.1, connections are kept alive between requests.
+    
+    POST /analyze with {"frames": [...], "roi": ..., "sigma": ...}, where
+    roi, sigma, cal and background are defaults for the frames, answers
+    {"results": [...]} in the same order, see _analyze_request.
+    GET /status answers the optimizer parameters and the number of workers.
+    """
+    protocol_version = 'HTTP/1.1'
+    
+    def send_json(self, obj, code=200):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json({'params': self.server.params,
+                            'workers': self.server.workers})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+    
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length).decode())
+        except:
+            self.send_json({'error': 'invalid json'}, 400)
+            return
+        if self.path != '/analyze':
+            self.send_json({'error': 'not found'}, 404)
+            return
+        defaults = {key: request[key] for key in ['roi', 'sigma', 'cal', 'background'] \
+                if key in request}
+        frames = [dict(defaults, **frame) for frame in request.get('frames', [])]
+        params = dict(self.server.params, **request.get('params', {}))
+        jobs = [self.server.pool.submit(_analyze_request, frame, params) for frame in frames]
+        self.send_json({'results': [job.result() for job in jobs]})
+    
+    def log_message(self, format, *args):
+        pass
+
+
+class AnalysisService(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ The engine as a local service: each connection has its own thread,
+        the frames of all requests share one process pool, so frames sent
+        in one request are analyzed in parallel.
+    """
+    daemon_threads = True
+    
+    def __init__(self, address=(_service_host, _service_port), params=None, workers=None):
+        super().__init__(address, ServiceHandler)
+        self.params = NPCEngine(params).params
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = futures.ProcessPoolExecutor(self.workers)
+    
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+
+class AnalysisClient(object):
+    """ Client of AnalysisService, reusing one connection. It stands in for
+        the acquisition software when testing.
+    """
+    def __init__(self, host=_service_host, port=_service_port, timeout=None):
+        self.conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    
+    def request(self, method, path, obj=None):
+        body = json.dumps(obj).encode() if obj is not None else None
+        headers = {'Content-Type': 'application/json'} if body else {}
+        self.conn.request(method, path, body, headers)
+        response = self.conn.getresponse()
+        return json.loads(response.read().decode())
+    
+    def status(self):
+        return self.request('GET', '/status')
+    
+    def analyze(self, frames, **defaults):
+        """ Analyze frames in one batch, frames are image fullnames or dicts,
+            see _analyze_request. defaults are roi, sigma, cal, background.
+        """
+        frames = [{'image': f} if isinstance(f, str) else f for f in frames]
+        request = dict(defaults, frames=frames)
+        return self.request('POST', '/analyze', request)['results']
+    
+    def analyze_array(self, array, roi=None, sigma=0.0):
+        array = np.ascontiguousarray(array)
+        frame = {'data': base64.b64encode(array.tobytes()).decode(),
+                 'shape': list(array.shape),
+                 'dtype': array.dtype.str,
+                 'roi': list(roi) if roi and roi != 'auto' else roi,
+                 'sigma': sigma}
+        return self.analyze([frame])[0]
+    
+    def close(self):
+        self.conn.close()
+
+
+def serve(port=_service_port, workers=None):
+    service = AnalysisService((_service_host, port), workers=workers)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
 
 
 class Main(QtGui.QMainWindow):
@@ -54,6 +2410,7 @@ class Main(QtGui.QMainWindow):
         # Set menus
         self.create_actions()
         self.create_menus()
+        self.image_display.enable_cache(self.cache_act.isChecked())
         # Set other stuff
         self.printer = QtGui.QPrinter()
         
@@ -63,6 +2420,9 @@ class Main(QtGui.QMainWindow):
     
     def closeEvent(self, e):
         self.image_display.plot.setVisible(False)
+        if self.image_display.cube is not None:
+            self.image_display.cube.close()
+        self.image_display.watch(False)
         super().closeEvent(e)
     
     def center(self):
@@ -82,7 +2442,12 @@ class Main(QtGui.QMainWindow):
             rect_size.scale(image.size(), QtCore.Qt.KeepAspectRatioByExpanding)
             rect.setSize(rect_size)
             painter.setWindow(rect)
-            image.render(painter)
+            image.printing = 1
+            try:
+                image.render(painter)
+            finally:
+                image.printing = 0
+                image.invalidate('image', 'analysis') # drop the full label layers
             painter.end()
     
     def about(self):
@@ -112,6 +2477,12 @@ class Main(QtGui.QMainWindow):
                 triggered=self.image_display.choose_dir,
                 shortcutContext=QtCore.Qt.ApplicationShortcut)
         
+        self.save_session_act = QtGui.QAction("&Save Session...", self,
+                triggered=self.image_display.save_session)
+        
+        self.load_session_act = QtGui.QAction("Open Sessi&on...", self,
+                triggered=self.image_display.load_session)
+        
         self.print_act = QtGui.QAction("&Print...", self,
                 shortcut="Ctrl+P",
                 enabled=False, triggered=self.print_,
@@ -147,6 +2518,71 @@ class Main(QtGui.QMainWindow):
                 enabled=False, triggered=self.image_display.sigma_line_down,
                 shortcutContext=QtCore.Qt.ApplicationShortcut)
         
+        self.add_roi_act = QtGui.QAction("Add Selection to R&OIs", self,
+                shortcut="Ctrl+Shift+A",
+                triggered=self.image_display.add_roi,
+                shortcutContext=QtCore.Qt.ApplicationShortcut)
+        
+        self.clear_rois_act = QtGui.QAction("&Clear ROIs", self,
+                enabled=False, triggered=self.image_display.clear_rois)
+        
+        self.auto_roi_act = QtGui.QAction("Auto &Select Pattern", self,
+                shortcut="Ctrl+Shift+S",
+                enabled=False, triggered=self.image_display.auto_roi_act,
+                shortcutContext=QtCore.Qt.ApplicationShortcut)
+        
+        self.track_act = QtGui.QAction("&Track Pattern Drift", self,
+                checkable=True, triggered=self.image_display.reset_track)
+        self.track_act.setChecked(False)
+        
+        self.auto_roi_always_act = QtGui.QAction("Auto Select Pattern on &New Image", self,
+                checkable=True)
+        self.auto_roi_always_act.setChecked(False)
+        
+        self.analyze_cube_act = QtGui.QAction("Analyze Whole Series as Cu&be", self,
+                enabled=False, triggered=self.image_display.analyze_cube)
+        
+        self.auto_sigma_act = QtGui.QAction("Auto S&igma", self,
+                shortcut="Ctrl+Shift+G",
+                enabled=False, triggered=self.image_display.auto_sigma,
+                shortcutContext=QtCore.Qt.ApplicationShortcut)
+        
+        self.auto_sigma_batch_act = QtGui.QAction("Auto Sigma in &Batch Jobs", self,
+                checkable=True)
+        
+        self.mask_lines_act = QtGui.QAction("&Mask Lines out of Brightness", self,
+                checkable=True, triggered=self.image_display.mask_lines)
+        self.mask_lines_act.setChecked(False)
+        self.mask_lines_act.setStatusTip('Off by default: the reflectivity is then '
+                'computed from the whole brightness regions')
+        
+        self.line_window_act = QtGui.QAction("Line Angle &Window...", self,
+                triggered=self.image_display.set_line_window)
+        
+        self.annulus_act = QtGui.QAction("A&nnulus Background", self,
+                checkable=True, triggered=self.image_display.set_outer_method)
+        
+        self.sweep_act = QtGui.QAction("Parameter S&weep", self,
+                enabled=False, triggered=self.image_display.sweep)
+        
+        self.pipeline_act = QtGui.QAction("Batch in Staged &Pipeline", self,
+                checkable=True)
+        
+        self.watch_act = QtGui.QAction("&Watch Directory", self,
+                checkable=True, triggered=self.image_display.watch)
+        
+        self.cache_act = QtGui.QAction("Use Result &Cache", self,
+                checkable=True, triggered=self.image_display.enable_cache)
+        self.cache_act.setChecked(True)
+        
+        self.batch_act = QtGui.QAction("Batch Analyze &Directory", self,
+                enabled=False, triggered=self.image_display.batch_analyze)
+        
+        self.analyze_rois_act = QtGui.QAction("Analyze &All ROIs", self,
+                shortcut="Ctrl+Shift+R",
+                enabled=False, triggered=self.image_display.analyze_rois,
+                shortcutContext=QtCore.Qt.ApplicationShortcut)
+        
         self.add_act = QtGui.QAction("&Add Data Point", self,
                 shortcut="Ctrl+A",
                 enabled=False, triggered=self.image_display.add_act,
@@ -244,6 +2680,22 @@ class Main(QtGui.QMainWindow):
                 shortcutContext=QtCore.Qt.ApplicationShortcut)
         self.keep_drawing_act.setChecked(True)
         
+        self.export_precision_act = QtGui.QAction("CSV &Precision...", self,
+                triggered=self.image_display.set_export_precision)
+        
+        self.browse_store_act = QtGui.QAction("&Browse Results Store", self,
+                triggered=self.image_display.browse_store)
+        
+        self.prev_store_page_act = QtGui.QAction("Pre&vious Store Page", self,
+                shortcut="Ctrl+PgUp",
+                triggered=self.image_display.prev_store_page,
+                shortcutContext=QtCore.Qt.ApplicationShortcut)
+        
+        self.next_store_page_act = QtGui.QAction("Ne&xt Store Page", self,
+                shortcut="Ctrl+PgDown",
+                triggered=self.image_display.next_store_page,
+                shortcutContext=QtCore.Qt.ApplicationShortcut)
+        
         self.about_act = QtGui.QAction("&About", self,
                 triggered=self.about)
     
@@ -251,6 +2703,10 @@ class Main(QtGui.QMainWindow):
         self.file_menu = QtGui.QMenu("&File", self)
         self.file_menu.addAction(self.open_act)
         self.file_menu.addAction(self.choose_dir_act)
+        self.file_menu.addSeparator()
+        self.file_menu.addAction(self.load_session_act)
+        self.file_menu.addAction(self.save_session_act)
+        self.file_menu.addSeparator()
         self.file_menu.addAction(self.print_act)
         self.file_menu.addSeparator()
         self.file_menu.addAction(self.exit_act)
@@ -279,6 +2735,26 @@ class Main(QtGui.QMainWindow):
         self.analyze_menu.addAction(self.sigma_down_act)
         self.analyze_menu.addAction(self.sigma_line_up_act)
         self.analyze_menu.addAction(self.sigma_line_down_act)
+        self.analyze_menu.addAction(self.line_window_act)
+        self.analyze_menu.addAction(self.mask_lines_act)
+        self.analyze_menu.addAction(self.auto_sigma_act)
+        self.analyze_menu.addAction(self.auto_sigma_batch_act)
+        self.analyze_menu.addAction(self.annulus_act)
+        self.analyze_menu.addSeparator()
+        self.analyze_menu.addAction(self.auto_roi_act)
+        self.analyze_menu.addAction(self.auto_roi_always_act)
+        self.analyze_menu.addAction(self.track_act)
+        self.analyze_menu.addSeparator()
+        self.analyze_menu.addAction(self.add_roi_act)
+        self.analyze_menu.addAction(self.clear_rois_act)
+        self.analyze_menu.addAction(self.analyze_rois_act)
+        self.analyze_menu.addAction(self.analyze_cube_act)
+        self.analyze_menu.addAction(self.batch_act)
+        self.analyze_menu.addAction(self.pipeline_act)
+        self.analyze_menu.addAction(self.watch_act)
+        self.analyze_menu.addAction(self.sweep_act)
+        self.analyze_menu.addSeparator()
+        self.analyze_menu.addAction(self.cache_act)
         
         self.data_menu = QtGui.QMenu("&Data", self)
         self.data_menu.addAction(self.add_act)
@@ -288,6 +2764,11 @@ class Main(QtGui.QMainWindow):
         self.data_menu.addSeparator()
         self.data_menu.addAction(self.preview_act)
         self.data_menu.addAction(self.export_act)
+        self.data_menu.addAction(self.export_precision_act)
+        self.data_menu.addSeparator()
+        self.data_menu.addAction(self.browse_store_act)
+        self.data_menu.addAction(self.prev_store_page_act)
+        self.data_menu.addAction(self.next_store_page_act)
         self.data_menu.addSeparator()
         self.data_menu.addAction(self.preview_always_on_top_act)
         
@@ -307,6 +2788,15 @@ class Main(QtGui.QMainWindow):
         self.zoomin_act.setEnabled(state)
         self.zoomout_act.setEnabled(state)
         self.normalsize_act.setEnabled(state)
+        self.auto_roi_act.setEnabled(state)
+        self.analyze_cube_act.setEnabled(state)
+        self.batch_act.setEnabled(state and (self.image_display.worker is None))
+        self.sweep_act.setEnabled(state and (self.image_display.worker is None))
+        self.auto_sigma_act.setEnabled(state and (self.image_display.worker is None))
+        self.browse_store_act.setEnabled(self.image_display.store is not None)
+        self.prev_store_page_act.setEnabled(self.image_display.store_page > 0)
+        self.next_store_page_act.setEnabled(self.image_display.store_page >= 0)
+        self.image_display.update_rois()
 
 
 class MyTableWidgetItem(QtGui.QTableWidgetItem):
@@ -360,7 +2850,12 @@ class MyDataTable(QtGui.QTableWidget):
         self.setItem(r, 0, space1)
         self.setItem(r, 1, space2)
     
-    def add_data(self, data):
+    def add_data(self, data, rect=None, image=None, page=None, record=None, sigma=None):
+        """ Add a data point to the table. The point is also appended to the
+            results store, unless its record is given, i.e. it is read back
+            from the store or from a session. sigma defaults to the current
+            one.
+        """
         r = self.rowCount()
         self.insertRow(r)
         wave = MyTableWidgetItem(data[0], self.display.count)
@@ -372,21 +2867,28 @@ class MyDataTable(QtGui.QTableWidget):
         fwhm = QtGui.QTableWidgetItem(data[3] if data[3] else 'unknown')
         fwhm.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
         
+        sorting = self.isSortingEnabled() # off while adding many points
         self.setSortingEnabled(False)
         self.setItem(r, 0, wave)
         self.setItem(r, 1, refl)
         self.setItem(r, 2, pola)
         self.setItem(r, 3, fwhm)
-        self.setSortingEnabled(True)
+        self.setSortingEnabled(sorting)
         
-        self.display.record[self.display.count] = [self.display.image,
-                self.display.scale_factor,
-                self.display.lbl.sel_rect,
-                self.display.sigma_value_spin.value(),
-                self.display.sigma_line_value_spin.value(),
-                self.display.bg_cbox.isChecked(),
-                self.display.scroll.horizontalScrollBar().value(),
-                self.display.scroll.verticalScrollBar().value()]
+        if record is None:
+            record = [self.display.image if image is None else image,
+                    self.display.scale_factor,
+                    self.display.lbl.sel_rect if rect is None else rect,
+                    self.display.sigma_value_spin.value() if sigma is None else sigma,
+                    self.display.sigma_line_value_spin.value(),
+                    self.display.bg_cbox.isChecked(),
+                    self.display.scroll.horizontalScrollBar().value(),
+                    self.display.scroll.verticalScrollBar().value(),
+                    self.display.page if image is None else page]
+            self.display.store_point(data, record)
+        self.display.record[self.display.count] = record
+        self.display.values[self.display.count] = (to_float(data[0]), to_float(data[1]),
+                data[2] if data[2] else 'unknown', to_float(data[3]))
         self.display.count += 1
     
     def replace_data(self, wavelength, reflectivity):
@@ -402,6 +2904,7 @@ class MyDataTable(QtGui.QTableWidget):
         self.setItem(row, 1, refl)
         self.setSortingEnabled(True)
         
+        self.display.values[id] = (to_float(wavelength), to_float(reflectivity)) +                 self.display.values[id][2:]
         self.display.record[id] = [self.display.image,
                 self.display.scale_factor,
                 self.display.lbl.sel_rect,
@@ -409,12 +2912,67 @@ class MyDataTable(QtGui.QTableWidget):
                 self.display.sigma_line_value_spin.value(),
                 self.display.bg_cbox.isChecked(),
                 self.display.scroll.horizontalScrollBar().value(),
-                self.display.scroll.verticalScrollBar().value()]
+                self.display.scroll.verticalScrollBar().value(),
+                self.display.page]
+    
+    def add_many(self, points):
+        """ Add (data, record) pairs at once, sorting only at the end. """
+        self.setUpdatesEnabled(False)
+        self.setSortingEnabled(False)
+        try:
+            for data, record in points:
+                self.add_data(data, record=record)
+        finally:
+            self.setSortingEnabled(True)
+            self.setUpdatesEnabled(True)
+    
+    def get_session(self):
+        """ The table and the records as a structured array, in row order.
+        
+        Returns:
+        points ndarray, images ndarray -- the text fields are as wide as
+        their longest value, images are kept apart.
+        """
+        n = self.rowCount()
+        texts = [[self.item(i, j).text() for j in range(_session_texts)] for i in range(n)]
+        dtype = [(name, 'U{0}'.format(max([len(t[j]) for t in texts]+[1]))) \
+                for j, (name, kind) in enumerate(_session_dtype[:_session_texts])]
+        points = np.zeros(n, dtype+_session_dtype[_session_texts:])
+        images = []
+        for i in range(n):
+            record = self.display.record[self.item(i, 0).id]
+            rect = record[2]
+            points[i] = tuple(texts[i])+(record[8] or 0, record[1],
+                    (rect.x(), rect.y(), rect.width(), rect.height()),
+                    record[3], record[4], record[5], (record[6], record[7]))
+            images.append(record[0])
+        return points, np.array(images, dtype=str)
+    
+    def set_session(self, points, images):
+        """ Fill the table from get_session arrays. Nothing is decoded here,
+            frames are only read when a point is restored.
+        """
+        self.clear_data()
+        pairs = []
+        for point, image in zip(points.tolist(), images.tolist()):
+            wave, refl, pola, fwhm, page, scale, rect, sigma, sigma_line, bg, scroll = point
+            record = [image, scale, QtCore.QRect(*rect), sigma, sigma_line, bg,
+                    scroll[0], scroll[1], page]
+            pairs.append(([wave, refl, '' if pola == 'unknown' else pola,
+                    '' if fwhm == 'unknown' else fwhm], record))
+        self.add_many(pairs)
+    
+    def clear_data(self):
+        for row in range(self.rowCount()):
+            del self.display.record[self.item(row, 0).id]
+            del self.display.values[self.item(row, 0).id]
+        self.setRowCount(0)
     
     def del_selected_rows(self):
         rows = self.selected_rows()
         for row in rows[::-1]:
             del self.display.record[self.item(row, 0).id]
+            del self.display.values[self.item(row, 0).id]
             self.removeRow(row)
     
     def get_data(self):
@@ -438,6 +2996,27 @@ class MyDataTable(QtGui.QTableWidget):
             pass
         return data, data_dict, sel_data
     
+    def get_columns(self):
+        """ The table as numeric columns, sorted by wavelength, unknown
+            numbers are nan. They are built from the numbers kept with the
+            records, the cells are not read back.
+        
+        Returns:
+        dict of ndarrays: wavelength, reflectivity, polarization, fwhm,
+        image, page.
+        """
+        ids = list(self.display.values)
+        values = [self.display.values[i] for i in ids]
+        records = [self.display.record[i] for i in ids]
+        columns = {'wavelength': np.array([v[0] for v in values], float),
+                   'reflectivity': np.array([v[1] for v in values], float),
+                   'polarization': np.array([v[2] for v in values], dtype=str),
+                   'fwhm': np.array([v[3] for v in values], float),
+                   'image': np.array([r[0] for r in records], dtype=str),
+                   'page': np.array([r[8] or 0 for r in records], int)}
+        order = np.argsort(columns['wavelength'], kind='mergesort')
+        return {key: value[order] for key, value in columns.items()}
+    
     def get_data_text(self):
         sep_head = ' '*4
         sep = ' '*4
@@ -551,6 +3130,106 @@ class MyMplCanvas(FigureCanvas):
             drag.exec_()
 
 
+class MyWorker(QtCore.QThread):
+    """ Run a function in the background and hand its result back to the
+        gui thread through the done or failed signal.
+    """
+    done = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+    
+    def __init__(self, parent, function, *args, **kwargs):
+        super().__init__(parent)
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+    
+    def run(self):
+        try:
+            result = self.function(*self.args, **self.kwargs)
+        except:
+            self.failed.emit(traceback.format_exc())
+        else:
+            self.done.emit(result)
+
+
+class MyWatcher(QtCore.QThread):
+    """ Watch a directory for new frames and analyze them as they come.
+        Frames go through a bounded queue: when the analysis falls behind,
+        the scanning thread blocks on the full queue, and the frames pile up
+        on disk instead of in memory.
+    """
+    done = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+    
+    def __init__(self, parent, path, params=None, roi=None, sigma=0.0, cal_data=None,
+            background=True, cache=None):
+        super().__init__(parent)
+        self.path = path
+        self.engine = NPCEngine(params)
+        self.cache = cache # ResultCache filename, opened by the analyzing thread
+        self.args = (roi, sigma, cal_data, background)
+        self.queue = queue.Queue(_watch_queue)
+        self.stopped = threading.Event()
+        self.seen = set(self.scan()) # only frames added from now on
+    
+    def scan(self):
+        return [f for f in os.listdir(self.path) if os.path.splitext(f)[1] in _formats]
+    
+    def stop(self):
+        self.stopped.set()
+    
+    def put(self, fullname):
+        """ Queue a frame, waiting while the queue is full. """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(fullname, timeout=_watch_interval)
+                return
+            except queue.Full:
+                pass
+    
+    def analyze(self):
+        if self.cache:
+            self.engine.cache = ResultCache(self.cache)
+        while not self.stopped.is_set():
+            try:
+                fullname = self.queue.get(timeout=_watch_interval)
+            except queue.Empty:
+                continue
+            try:
+                if self.engine.is_stack(fullname):
+                    results = list(self.engine.analyze_stack(fullname, *self.args))
+                else:
+                    results = [self.engine.analyze_frame(fullname, *self.args)]
+            except:
+                self.failed.emit(traceback.format_exc())
+            else:
+                self.done.emit(results)
+    
+    def run(self):
+        consumer = threading.Thread(target=self.analyze)
+        consumer.start()
+        sizes = {} # new files are queued once their size stops changing
+        try:
+            while not self.stopped.wait(_watch_interval):
+                for f in sorted(set(self.scan())-self.seen):
+                    fullname = os.path.join(self.path, f)
+                    try:
+                        size = os.path.getsize(fullname)
+                    except OSError:
+                        continue
+                    if sizes.get(f) != size:
+                        sizes[f] = size # still being written
+                        continue
+                    del sizes[f]
+                    self.seen.add(f)
+                    self.put(fullname)
+        except:
+            self.failed.emit(traceback.format_exc())
+        finally:
+            self.stopped.set()
+            consumer.join()
+
+
 class MyScrollArea(QtGui.QScrollArea):
     def __init__(self, parent):
         super().__init__(parent)
@@ -564,8 +3243,7 @@ class MyScrollArea(QtGui.QScrollArea):
                 extra_size = QtCore.QSize(2, 2)
             else:
                 extra_size = QtCore.QSize(2, 23)
-            h, w = self.parent().matrix.shape
-            return QtCore.QSize(w+2, h+2)+extra_size
+            return self.parent().display_size()+QtCore.QSize(2, 2)+extra_size
         else:
             return _size
     
@@ -582,6 +3260,8 @@ class MyImageLabel(QtGui.QLabel):
         self.x = 0
         self.y = 0
         self.flag = 1 # drawing flag
+        self.layers = {} # cached (tile, pixmap) layers, see get_layer
+        self.printing = 0 # render the whole label instead of the viewport
         self.initUI()
     
     def initUI(self):
@@ -593,25 +3273,152 @@ class MyImageLabel(QtGui.QLabel):
     
     def sizeHint(self):
         if self.display.image:
-            h, w = self.display.matrix.shape
-            return QtCore.QSize(w+2, h+2)
+            return self.display.display_size()+QtCore.QSize(2, 2)
         else:
             return super().sizeHint()
     
-    def paintEvent(self, e):
-        super().paintEvent(e)
+    def paintEvent(self, e):
+        super().paintEvent(e)
+        qp = QtGui.QPainter()
+        qp.begin(self)
+        self.draw_text(e, qp)
+        if self.display.image:
+            self.draw_layer(e, qp, 'image')
+            if self.display.analyze_btn.isChecked() and self.flag:
+                self.draw_layer(e, qp, 'analysis')
+        self.draw_rois(qp)
+        self.draw_rect(qp)
+        self.draw_stat(e, qp)
+        self.draw_info(e, qp)
+        qp.end()
+    
+    def resizeEvent(self, e):
+        self.invalidate('image', 'analysis')
+        super().resizeEvent(e)
+    
+    # overlay layer methods
+    def invalidate(self, *names):
+        """ Drop the cached layers so that they will be rendered again on
+            the next paint. If no name is given, drop all of them.
+        
+        Keyword arguments:
+        names -- layer names, could be 'image', 'analysis', 'stat' or 'info'.
+        """
+        for name in (names or list(self.layers.keys())):
+            self.layers.pop(name, None)
+    
+    def get_layer(self, name, rect=None):
+        """ Get the cached transparent pixmap of the layer, render it first
+            if it has been invalidated or doesn't cover rect.
+        
+        Keyword arguments:
+        name -- layer name, see invalidate.
+        rect -- QRect in label coordinates the layer has to cover, only
+            meaningful for the tiled layers ('image' and 'analysis').
+        
+        Returns:
+        QRect tile, QPixmap layer.
+        """
+        layer = self.layers.get(name)
+        if (layer is None) or ((rect is not None) and not layer[0].contains(rect)):
+            self.layers[name] = layer = getattr(self, 'render_'+name)(rect)
+        return layer
+    
+    def visible_rect(self, margin=0):
+        rect = self.visibleRegion().boundingRect()
+        return rect.adjusted(-margin, -margin, margin, margin)
+    
+    def tile_rect(self, rect):
+        """ The part of the label worth rendering: the viewport with some
+            margin, plus rect when it lies outside of the viewport (while
+            printing).
+        """
+        tile = self.visible_rect(_margin)
+        if rect is not None:
+            tile = tile.united(rect)
+        return tile.intersected(self.rect())
+    
+    def new_layer(self, size):
+        layer = QtGui.QPixmap(size)
+        layer.fill(QtCore.Qt.transparent)
+        return layer
+    
+    def render_image(self, rect):
+        """ Render only the visible part of the zoomed image, straight from
+            the native matrix, so that memory use doesn't grow with zoom.
+        """
+        tile = self.tile_rect(rect)
+        layer = self.new_layer(tile.size())
+        area = tile.intersected(QtCore.QRect(QtCore.QPoint(1, 1),
+                self.display.display_size()))
+        if not area.isEmpty():
+            matrix = self.display.matrix
+            h, w = matrix.shape
+            s = self.display.scale_factor
+            cols = (np.arange(area.left(), area.right()+1)-1)/s
+            rows = (np.arange(area.top(), area.bottom()+1)-1)/s
+            cols = np.minimum(cols.astype(int), w-1)
+            rows = np.minimum(rows.astype(int), h-1)
+            imag = self.display.gray2qimage(matrix[np.ix_(rows, cols)])
+            qp = QtGui.QPainter()
+            qp.begin(layer)
+            qp.drawImage(area.topLeft()-tile.topLeft(), imag)
+            qp.end()
+        return tile, layer
+    
+    def render_analysis(self, rect):
+        tile = self.tile_rect(rect)
+        layer = self.new_layer(tile.size())
+        qp = QtGui.QPainter()
+        qp.begin(layer)
+        qp.translate(QtCore.QPoint(1, 1)-tile.topLeft())
+        self.draw_edge_points(qp, tile.translated(-1, -1))
+        self.draw_lines(qp)
+        self.draw_inner_rect(qp)
+        self.draw_outer_rects(qp)
+        qp.end()
+        return tile, layer
+    
+    def render_stat(self, rect=None):
+        points = 12 if os.name == 'posix' else 9
+        font = QtGui.QFont('Courier', points, QtGui.QFont.Light)
+        text = self.display.stat_text()
+        rect = QtGui.QFontMetrics(font).boundingRect(QtCore.QRect(0, 0, 1000, 1000),
+                QtCore.Qt.AlignLeft, text)
+        rect.moveTopLeft(QtCore.QPoint(0, 0))
+        layer = self.new_layer(rect.size())
+        qp = QtGui.QPainter()
+        qp.begin(layer)
+        qp.setPen(QtCore.Qt.red)
+        qp.setFont(font)
+        qp.drawText(rect, QtCore.Qt.AlignLeft, text)
+        qp.end()
+        return rect, layer
+    
+    def render_info(self, rect=None):
+        height = 105 if os.name == 'posix' else 120
+        rect = QtCore.QRect(0, 0, 210, height)
+        layer = self.new_layer(rect.size()+QtCore.QSize(1, 1))
         qp = QtGui.QPainter()
-        qp.begin(self)
-        self.draw_text(e, qp)
-        if self.display.analyze_btn.isChecked() and self.flag:
-            self.draw_edge_points(qp)
-            self.draw_lines(qp)
-            self.draw_inner_rect(qp)
-            self.draw_outer_rects(qp)
-        self.draw_rect(qp)
-        self.draw_stat(e, qp)
-        self.draw_info(e, qp)
+        qp.begin(layer)
+        qp.setPen(QtCore.Qt.black)
+        qp.setBrush(QtCore.Qt.black)
+        qp.drawRect(rect)
+        qp.setPen(QtCore.Qt.white)
+        points = 12 if os.name == 'posix' else 8
+        qp.setFont(QtGui.QFont('Courier', points, QtGui.QFont.Light))
+        qp.drawText(rect.translated(16, 10), QtCore.Qt.AlignLeft,
+                self.display.info_text())
         qp.end()
+        return layer.rect(), layer
+    
+    # drawing methods
+    def draw_layer(self, e, qp, name):
+        rect = e.rect()
+        if not self.printing:
+            rect = rect.intersected(self.visible_rect())
+        tile, layer = self.get_layer(name, rect)
+        qp.drawPixmap(tile.topLeft(), layer)
     
     def draw_text(self, e, qp):
         if not self.display.image:
@@ -621,34 +3428,31 @@ class MyImageLabel(QtGui.QLabel):
     
     def draw_stat(self, e, qp):
         if self.display.parent().show_stat_act.isChecked():
-            qp.setPen(QtCore.Qt.red)
-            points = 12 if os.name == 'posix' else 9
-            qp.setFont(QtGui.QFont('Courier', points, QtGui.QFont.Light))
-            qp.drawText(e.rect().translated(16, 10), QtCore.Qt.AlignLeft,
-                    self.display.stat_text())
+            qp.drawPixmap(e.rect().topLeft()+QtCore.QPoint(16, 10),
+                    self.get_layer('stat')[1])
     
     def draw_info(self, e, qp):
         if self.display.parent().show_info_act.isChecked():
-            height = 105 if os.name == 'posix' else 120
-            rect = QtCore.QRect(0, 0, 210, height)
-            rect.moveBottomRight(e.rect().bottomRight())
-            qp.setPen(QtCore.Qt.black)
-            qp.setBrush(QtCore.Qt.black)
-            qp.drawRect(rect)
-            qp.setPen(QtCore.Qt.white)
-            points = 12 if os.name == 'posix' else 8
-            qp.setFont(QtGui.QFont('Courier', points, QtGui.QFont.Light))
-            qp.drawText(rect.translated(16, 10), QtCore.Qt.AlignLeft,
-                    self.display.info_text())
+            rect, layer = self.get_layer('info')
+            rect = QtCore.QRect(rect)
+            rect.moveBottomRight(e.rect().bottomRight()+QtCore.QPoint(1, 1))
+            qp.drawPixmap(rect.topLeft(), layer)
+    
+    def draw_rois(self, qp):
+        qp.setPen(QtCore.Qt.yellow)
+        for roi in self.display.rois:
+            qp.drawRect(self.display.to_sel_rect(roi))
     
     def draw_rect(self, qp):
         qp.setPen(QtCore.Qt.red)
         if not self.sel_rect.isNull():
             qp.drawRect(self.sel_rect.normalized())
     
+    # the methods below draw native analysis results onto a painter that is
+    # already translated by the label border
     def draw_lines(self, qp):
         if self.display.parent().show_lines_act.isChecked():
-            lines = [line.translated(1, 1) for line in self.display.lines]
+            lines = [self.display.to_label(line) for line in self.display.lines]
             qp.setPen(QtCore.Qt.magenta)
             qp.drawLines(lines)
     
@@ -656,26 +3460,68 @@ class MyImageLabel(QtGui.QLabel):
         if self.display.parent().show_squares_act.isChecked():
             qp.setPen(QtCore.Qt.green)
             if not self.display.inner_rect.isEmpty():
-                qp.drawRect(self.display.inner_rect.translated(1, 1))
+                qp.drawRect(self.display.to_label(self.display.inner_rect))
     
     def draw_outer_rects(self, qp):
         if self.display.parent().show_squares_act.isChecked():
             qp.setPen(QtCore.Qt.blue)
             for rect in self.display.outer_rects:
                 if not rect.isEmpty():
-                    qp.drawRect(rect.translated(1, 1))
+                    qp.drawRect(self.display.to_label(rect))
     
-    def draw_edge_points(self, qp):
+    def draw_edge_points(self, qp, rect):
         if self.display.parent().show_edges_act.isChecked():
-            qp.setPen(QtCore.Qt.darkBlue)
-            qp.drawPoints(self.display.edge_points.translated(1, 1))
+            s = self.display.scale_factor
+            # points sit at the center of their native pixels
+            points = self.decimate_points(self.display.edge_points+0.5, rect, s)
+            pen = QtGui.QPen(QtCore.Qt.darkBlue)
+            pen.setWidth(max(int(s), 1))
+            qp.setPen(pen)
+            qp.drawPoints(self.to_polygon(points))
+    
+    def decimate_points(self, points, rect, scale=1.0):
+        """ Keep only the points that would be visible in rect.
+        
+        Points falling onto the same screen pixel at the given scale are
+        merged, and at most _max_edge_points points are kept.
+        
+        Keyword arguments:
+        points -- (n, 2) ndarray of x and y coordinates.
+        rect -- QRect in label coordinates.
+        scale -- factor mapping points to label coordinates.
+        
+        Returns:
+        (m, 2) int ndarray in label coordinates.
+        """
+        points = np.floor(scale*points).astype(int)
+        if rect.isEmpty() or not len(points):
+            return points[:0]
+        x, y = points[:, 0], points[:, 1]
+        mask = (x >= rect.left()) & (x <= rect.right()) & \
+                (y >= rect.top()) & (y <= rect.bottom())
+        points = points[mask]
+        if scale < 1.0:
+            idx = (points[:, 1]-rect.top())*rect.width()+(points[:, 0]-rect.left())
+            points = points[np.unique(idx, return_index=True)[1]]
+        if len(points) > _max_edge_points:
+            step = int(np.ceil(len(points)/_max_edge_points))
+            points = points[::step]
+        return points
+    
+    def to_polygon(self, points):
+        # convert the whole array in one call instead of one QPoint at a time
+        polygon = QtGui.QPolygon()
+        polygon.setPoints(points.ravel().tolist())
+        return polygon
     
     def show_pos_tip(self):
         if (self.x == 0) or (self.y == 0):
             brightness = '/'
         else:
             try:
-                brightness = self.display.matrix[self.y-1, self.x-1]
+                s = self.display.scale_factor
+                brightness = self.display.matrix[int((self.y-1)/s),
+                        int((self.x-1)/s)]
             except:
                 brightness = '/'
         flag = self.display.tooltips and self.frameRect().contains(
@@ -772,7 +3618,11 @@ class ImageDisplay(QtGui.QWidget):
     def __init__(self, parent):
         super().__init__(parent)
         self.image = '' # image fullname
-        self.matrix = None # image ndarray
+        self.page = 0 # page of the image, only for multi-page images
+        self.matrix = None # native image ndarray, never zoomed
+        self.integral = None # integral images of matrix
+        self.masked = None # (valid, integral) of matrix without the current lines
+        self.engine = NPCEngine() # headless analysis engine
         self.background = '' # background image fullname
         self.cal = '' # calibration file fullname
         self.cal_data = [] # calibration data
@@ -781,10 +3631,26 @@ class ImageDisplay(QtGui.QWidget):
         self.tooltips = 0 # switch tooltips on/off
         self.inner_rect = QtCore.QRect() # pattern area
         self.outer_rects = [] # bg areas list
-        self.edge_points = QtGui.QPolygon() # image canny edge points
+        self.edge_points = np.zeros((0, 2), int) # image canny edge points, (x, y) rows
         self.lines = [] # lines given by hough transform
         self.record = {} # record settings for each data point
+        self.values = {} # (wavelength, reflectivity, polarization, fwhm) of each data point, numbers parsed
+        self.rois = [] # native (x, y, w, h) rois analyzed together
+        self.track_ref = None # downsampled previous frame for drift tracking
+        self.restoring = False # True while a recorded data point is restored
+        self.cube = None # SpectralCube of the current series
+        self.cube_key = None # what the cube was built from
+        self.worker = None # running background MyWorker
+        self.watcher = None # MyWatcher of the current directory
         self.count = 0 # number of all data points taken from start
+        self.session = time.strftime('%Y%m%d-%H%M%S') # session name in the results store
+        self.store_page = -1 # page of the results store shown in the table, -1 if none
+        self.store_points = None # points of a batch stored at once, None outside batches
+        self.export_precision = 4 # decimals of CSV exports
+        try:
+            self.store = ResultStore() # results store, None if it couldn't be opened
+        except:
+            self.store = None
         self.stat = {'maximum':'',
                      'minimum':'',
                      'mean':'',
@@ -808,6 +3674,12 @@ class ImageDisplay(QtGui.QWidget):
         self.imag_list = imag_list = QtGui.QComboBox(self)
         imag_list.currentIndexChanged.connect(self.check_lists)
         
+        self.page_spin = page_spin = QtGui.QSpinBox(self)
+        page_spin.setFixedWidth(50)
+        page_spin.setEnabled(False)
+        page_spin.setToolTip('Page of the multi-page image')
+        page_spin.valueChanged[int].connect(self.set_page)
+        
         self.format_list = format_list = QtGui.QComboBox(self)
         format_list.setFixedWidth(70)
         format_list.addItems(_formats)
@@ -832,7 +3704,8 @@ class ImageDisplay(QtGui.QWidget):
         grid.addWidget(path_label, 1, 0, QtCore.Qt.AlignRight)
         grid.addWidget(path_list, 1, 1, 1, 4)
         grid.addWidget(imag_label, 2, 0, QtCore.Qt.AlignRight)
-        grid.addWidget(imag_list, 2, 1, 1, 3)
+        grid.addWidget(imag_list, 2, 1, 1, 2)
+        grid.addWidget(page_spin, 2, 3)
         grid.addWidget(format_list, 2, 4)
         grid.addWidget(cal_cbox, 3, 0, QtCore.Qt.AlignRight)
         grid.addWidget(cal_list, 3, 1, 1, 4)
@@ -851,8 +3724,9 @@ class ImageDisplay(QtGui.QWidget):
         
         self.sigma_sld = sigma_sld = QtGui.QSlider(QtCore.Qt.Horizontal, self)
         sigma_sld.setMinimum(0)
-        sigma_sld.setMaximum(100)
+        sigma_sld.setMaximum(10*_sigma_steps)
         sigma_sld.setTickPosition(QtGui.QSlider.TicksBelow)
+        sigma_sld.setTickInterval(_sigma_steps)
         sigma_sld.valueChanged.connect(self.change_sigma)
         
         sigma_line_label = QtGui.QLabel('Line')
@@ -866,8 +3740,9 @@ class ImageDisplay(QtGui.QWidget):
         
         self.sigma_line_sld = sigma_line_sld = QtGui.QSlider(QtCore.Qt.Horizontal, self)
         sigma_line_sld.setMinimum(0)
-        sigma_line_sld.setMaximum(100)
+        sigma_line_sld.setMaximum(10*_sigma_steps)
         sigma_line_sld.setTickPosition(QtGui.QSlider.TicksBelow)
+        sigma_line_sld.setTickInterval(_sigma_steps)
         sigma_line_sld.valueChanged.connect(self.change_sigma_line)
         
         zoom_label = QtGui.QLabel('Zoom')
@@ -1019,6 +3894,8 @@ class ImageDisplay(QtGui.QWidget):
                     pe.setCurrentIndex(idx)
     
     def set_lists(self, path='', silent=0):
+        if self.watcher is not None and self.watcher.path != self.path_list.currentText():
+            self.watch(True) # follow the directory shown
         self.set_imaglist(silent=1)
         self.set_callist(silent=1)
         if not silent:
@@ -1094,12 +3971,34 @@ class ImageDisplay(QtGui.QWidget):
         cal = os.path.join(path, self.cal_list.currentText())
         cal = cal if os.path.isfile(cal) else ''
         if (image != self.image) or (cal != self.cal):
-            self.image = image
+            if image != self.image:
+                self.image = image
+                self.set_pages()
             if cal != self.cal:
                 self.cal = cal
                 self.set_cal_data()
             self.update_total('dir')
     
+    def set_pages(self, page=0):
+        """ Set up the page spin box for the current image. """
+        pages = 1
+        if self.image and self.engine.is_stack(self.image):
+            try:
+                pages = self.engine.count_pages(self.image)
+            except:
+                pass
+        self.page = min(page, pages-1)
+        self.page_spin.blockSignals(True)
+        self.page_spin.setRange(0, pages-1)
+        self.page_spin.setValue(self.page)
+        self.page_spin.setEnabled(pages > 1)
+        self.page_spin.blockSignals(False)
+    
+    def set_page(self, page):
+        if page != self.page:
+            self.page = page
+            self.update_total('dir')
+    
     def check_bg(self):
         path = self.path_list.currentText()
         filename = self.bg_list.currentText()
@@ -1131,7 +4030,7 @@ class ImageDisplay(QtGui.QWidget):
         self.set_sigma_act(-0.10)
     
     def set_sigma(self, value):
-        sigma = round(10*value)
+        sigma = round(_sigma_steps*value)
         sigma_o = self.sigma_sld.value()
         if sigma_o != sigma:
             self.sigma_sld.setValue(sigma)
@@ -1139,22 +4038,23 @@ class ImageDisplay(QtGui.QWidget):
     
     def change_sigma(self):
         sigma = self.sigma_sld.value()
-        sigma_r = round(self.sigma_value_spin.value()*10)
+        sigma_r = round(self.sigma_value_spin.value()*_sigma_steps)
         if sigma_r != sigma:
-            self.sigma_value_spin.setValue(sigma*0.1)
+            self.sigma_value_spin.setValue(sigma/_sigma_steps)
     
     def set_sigma_line(self, value):
-        sigma = round(10*value)
+        sigma = round(_sigma_steps*value)
         sigma_o = self.sigma_line_sld.value()
         if sigma_o != sigma:
             self.sigma_line_sld.setValue(sigma)
+        self.engine.params['sigma_line'] = value
         self.update_total('sigma_line')
     
     def change_sigma_line(self):
         sigma = self.sigma_line_sld.value()
-        sigma_r = round(self.sigma_line_value_spin.value()*10)
+        sigma_r = round(self.sigma_line_value_spin.value()*_sigma_steps)
         if sigma_r != sigma:
-            self.sigma_line_value_spin.setValue(sigma*0.1)
+            self.sigma_line_value_spin.setValue(sigma/_sigma_steps)
     
     def set_sigma_line_act(self, step):
         value = max(min(self.sigma_line_value_spin.value()+step, 10.0), 0.0)
@@ -1167,11 +4067,33 @@ class ImageDisplay(QtGui.QWidget):
         self.set_sigma_line_act(-0.10)
     
     # image converting methods
-    def array2gray(self, array):
-        if np.ndim(array) == 3:
-            array = np.dot(array[..., :3], [0.2989, 0.5870, 0.1140]) # ignore alpha channel
-        gray = np.require(array, np.uint8, 'C')
-        return gray
+    def display_size(self):
+        """ Size of the zoomed image on the label, without the border. """
+        h, w = self.matrix.shape
+        s = self.scale_factor
+        return QtCore.QSize(round(w*s), round(h*s))
+    
+    def native_bounds(self, rect):
+        """ Map a rect in label coordinates to native matrix bounds.
+        
+        Returns:
+        x1, x2, y1, y2 -- to be used as matrix[y1:y2, x1:x2].
+        """
+        s = self.scale_factor
+        x1 = max(int(np.floor((rect.left()-1)/s)), 0)
+        x2 = int(np.floor((rect.right()-1)/s))+1
+        y1 = max(int(np.floor((rect.top()-1)/s)), 0)
+        y2 = int(np.floor((rect.bottom()-1)/s))+1
+        return x1, x2, y1, y2
+    
+    def to_label(self, shape):
+        """ Map a native QRect or QLine to label coordinates (border excluded). """
+        s = self.scale_factor
+        if isinstance(shape, QtCore.QLine):
+            return QtCore.QLine(round(s*shape.x1()), round(s*shape.y1()),
+                    round(s*shape.x2()), round(s*shape.y2()))
+        return QtCore.QRect(round(s*shape.x()), round(s*shape.y()),
+                round(s*shape.width()), round(s*shape.height()))
     
     def gray2qimage(self, gray):
         gray = np.require(gray, np.uint32, 'C')
@@ -1182,47 +4104,9 @@ class ImageDisplay(QtGui.QWidget):
         return imag
     
     # calibrating and parsing methods
-    def modified(self, sample):
-        if not sample[1]:
-            sample[1] = sample[0]
-        return sample
-    
-    def get_raw_cal_data(self):
-        data = []
-        
-        with open(self.cal) as f:
-            reader = csv.reader(f)
-            flag = 0
-            data.append([])
-            for row in reader:
-                try:
-                    wavelength = float(row[0])
-                    data[-1].append(row)
-                    if not flag:
-                        flag = 1
-                except:
-                    if flag:
-                        flag = 0
-                        data.append([])
-        return data
-    
-    def get_cal_data(self):
-        data = self.get_raw_cal_data()
-        current_value = self.modified(data[0][0])[:]
-        for i in range(len(data)):
-            for j in range(len(data[i])):
-                sample = data[i][j]
-                for k in range(len(sample)):
-                    sample = self.modified(sample)
-                    if sample[k]:
-                        current_value[k] = sample[k]
-                    else:
-                        sample[k] = current_value[k]
-        return data
-    
     def set_cal_data(self):
         try:
-            self.cal_data = self.get_cal_data()
+            self.cal_data = self.engine.get_cal_data(self.cal)
         except:
             self.cal_data = []
     
@@ -1239,10 +4123,6 @@ class ImageDisplay(QtGui.QWidget):
         idx = (np.abs(array-value)).argmin()
         return array[idx]
     
-    def find_nearest_index(self, array, value):
-        idx = (np.abs(array-value)).argmin()
-        return idx
-    
     def name_parser(self, name):
         """ Parse the image name to get more information.
             The information will fill into self.info dictionary.
@@ -1253,34 +4133,11 @@ class ImageDisplay(QtGui.QWidget):
         for key in self.info.keys():
             self.info[key] = ''
         
-        try:
-            tokens = name.split('_')
-            if len(tokens) < 2:
-                peak = tokens[0]
-                turn = 0
-            else:
-                peak, turn = tokens[:2]
-            peak = float(peak.split('n')[0])
-            try:
-                turn = int(turn)
-            except:
-                turn = 0
-            self.info['wavelength'] = '{0:.3f}'.format(peak)
-            # calibration
-            if self.cal_cbox.isChecked() and self.cal:
-                data = np.array(self.cal_data)
-                part_data = np.concatenate(data[_filter[turn]])
-                peaks = part_data[:, 1].astype(float)
-                idx = self.find_nearest_index(peaks, peak)
-                self.info['FWHM'] = part_data[idx, 2]
-                self.info['exposure'] = part_data[idx, 3]
-                self.info['brightness'] = part_data[idx, 4]
-                self.info['gain'] = part_data[idx, 5]
-                self.info['polarization'] = part_data[idx, 6]
-                real_peak = peaks[idx]
-                self.info['wavelength'] = '{0:.3f}'.format(real_peak)
-        except:
-            pass
+        cal_data = self.cal_data if (self.cal_cbox.isChecked() and self.cal) else None
+        if self.engine.is_stack(self.image):
+            self.info.update(self.engine.page_info(name, self.page, cal_data))
+        else:
+            self.info.update(self.engine.parse_name(name, cal_data))
     
     def info_text(self):
         text = ['  wavelength: '+(self.info['wavelength'] and \
@@ -1303,27 +4160,13 @@ class ImageDisplay(QtGui.QWidget):
                 '    std: '+self.stat['std']]
         return '\n'.join(text)
     
-    def is_background(self, f):
-        exposure = self.info['exposure']
-        gain = self.info['gain']
-        polarization = self.info['polarization']
-        
-        name, suffix = os.path.splitext(f)
-        c0 = bool(suffix == self.format_list.currentText())
-        c1 = False
-        try:
-            parts = name.split('_')
-            if '/'.join(parts[1:3]) == exposure:
-                if (len(parts) == 3) or (parts[3] == polarization) or (parts[3] == gain):
-                    c1 = True
-        except:
-            pass
-        return (c0 and c1)
-    
     def set_background(self):
         try:
             path = self.path_list.currentText()
-            bgs = [f for f in os.listdir(path) if self.is_background(f)]
+            suffix = self.format_list.currentText()
+            if suffix in _stack_formats:
+                suffix = None
+            bgs = self.engine.find_backgrounds(path, self.info, suffix)
             self.background = os.path.join(path, bgs[0])
             self.bg_list.blockSignals(True)
             self.bg_list.clear()
@@ -1336,17 +4179,6 @@ class ImageDisplay(QtGui.QWidget):
             self.bg_list.blockSignals(False)
     
     # data editing methods
-    def cal_reflectivity(self, inner_b, outer_bs):
-        reflectivity = None
-        
-        if inner_b != None:
-            outer_bs = np.array(outer_bs)
-            mask = (outer_bs >= 0)
-            outer_bs = outer_bs[mask]
-            if (inner_b != -1) and len(outer_bs):
-                reflectivity = inner_b/np.mean(outer_bs)
-        return reflectivity
-    
     def add_point(self):
         data = []
         data.append(self.info['wavelength'])
@@ -1364,9 +4196,21 @@ class ImageDisplay(QtGui.QWidget):
         self.add_btn.click()
     
     def export_point(self):
-        filter_string = 'Text files (*.txt)'
+        filter_string = 'Text files (*.txt);;CSV files (*.csv);;'\
+                'NumPy archives (*.npz);;HDF5 files (*.h5)'
         fullname = QtGui.QFileDialog.getSaveFileName(self.parent(),
-                'Export data as text file (*.txt)', _home, filter_string)
+                'Export data', _home, filter_string)
+        if not fullname:
+            return
+        if os.path.splitext(fullname)[1].lower() in ['.csv', '.npz', '.h5', '.hdf5']:
+            if self.worker is not None:
+                msg = 'Please wait for the running job to finish.'
+                QtGui.QMessageBox.information(self, 'Export data', msg)
+                return
+            exporter = Exporter(self.export_precision)
+            self.start_worker(exporter.write, self.export_finished, fullname,
+                    self.table.get_columns(), dict(self.engine.params))
+            return
         try:
             with open(fullname, 'w') as f:
                 data = self.table.get_data_text()
@@ -1375,6 +4219,15 @@ class ImageDisplay(QtGui.QWidget):
             msg = 'Sorry, for some reason, exporting has failed...'
             QtGui.QMessageBox.information(self, 'Shit happens', msg)
     
+    def export_finished(self, fullname):
+        self.parent().statusBar().showMessage('Exported to {0}'.format(fullname), 5000)
+    
+    def set_export_precision(self):
+        value, ok = QtGui.QInputDialog.getInt(self, 'CSV precision',
+                'Decimals written to CSV files:', self.export_precision, 0, 12)
+        if ok:
+            self.export_precision = value
+    
     def export_act(self):
         self.export_btn.click()
     
@@ -1391,8 +4244,12 @@ class ImageDisplay(QtGui.QWidget):
         index_i = imags.index(filename)
         self.imag_list.setCurrentIndex(index_i)
         self.imag_list.blockSignals(False)
-        # restore the image and paint
-        self.update_total('dir')
+        # restore the image and paint, at the recorded selection
+        self.restoring = True
+        try:
+            self.update_total('dir')
+        finally:
+            self.restoring = False
         # restore menu
         self.parent().zoomin_act.setEnabled(self.scale_factor < 4.7)
         self.parent().zoomout_act.setEnabled(self.scale_factor > 0.21)
@@ -1407,6 +4264,7 @@ class ImageDisplay(QtGui.QWidget):
         row = self.table.selected_rows()[0]
         paras = self.record[self.table.item(row, 0).id]
         self.image = paras[0]
+        self.set_pages(paras[8] or 0)
         self.scale_factor = paras[1]
         self.lbl.sel_rect = paras[2]
         self.bg_cbox.blockSignals(True)
@@ -1415,12 +4273,13 @@ class ImageDisplay(QtGui.QWidget):
         self.bg_list.setEnabled(paras[5])
         self.sigma_value_spin.blockSignals(True)
         self.sigma_value_spin.setValue(paras[3])
-        self.sigma_sld.setValue(round(10*paras[3]))
+        self.sigma_sld.setValue(round(_sigma_steps*paras[3]))
         self.sigma_value_spin.blockSignals(False)
         self.sigma_line_value_spin.blockSignals(True)
         self.sigma_line_value_spin.setValue(paras[4])
-        self.sigma_line_sld.setValue(round(10*paras[4]))
+        self.sigma_line_sld.setValue(round(_sigma_steps*paras[4]))
         self.sigma_line_value_spin.blockSignals(False)
+        self.engine.params['sigma_line'] = paras[4]
         self.zoom_sld.blockSignals(True)
         self.zoom_sld.setValue(8+round(np.log(paras[1])/np.log(1.25)))
         self.zoom_value_label.setText("{0}%".format(round(100*paras[1])))
@@ -1452,6 +4311,119 @@ class ImageDisplay(QtGui.QWidget):
     def del_act(self):
         self.del_btn.click()
     
+    def save_session(self):
+        filter_string = 'NPC sessions (*{0})'.format(_session_format)
+        fullname = QtGui.QFileDialog.getSaveFileName(self.parent(),
+                'Save session', _home, filter_string)
+        if not fullname:
+            return
+        if not fullname.endswith(_session_format):
+            fullname += _session_format
+        try:
+            points, images = self.table.get_session()
+            with open(fullname, 'wb') as f:
+                np.savez_compressed(f, points=points, images=images,
+                        session=np.array(self.session))
+        except:
+            msg = 'Sorry, for some reason, saving the session has failed...'
+            QtGui.QMessageBox.information(self, 'Shit happens', msg)
+    
+    def load_session(self):
+        filter_string = 'NPC sessions (*{0})'.format(_session_format)
+        fullname = QtGui.QFileDialog.getOpenFileName(self.parent(),
+                'Open session', _home, filter_string)
+        if not fullname:
+            return
+        try:
+            with np.load(fullname) as f:
+                points, images = f['points'], f['images']
+            self.store_page = -1
+            self.table.set_session(points, images)
+        except:
+            msg = 'Sorry, for some reason, opening the session has failed...'
+            QtGui.QMessageBox.information(self, 'Shit happens', msg)
+            return
+        self.update_export()
+        if self.plot.isVisible():
+            self.plot.canvas.update_figure()
+        self.parent().update_actions()
+    
+    def store_point(self, data, record):
+        """ Append a data point of the table to the results store. """
+        if self.store is None:
+            return
+        roi = self.sel_roi(record[2]) if self.matrix is not None else None
+        point = {'session': self.session,
+                 'wavelength': data[0],
+                 'reflectivity': data[1],
+                 'polarization': data[2] or '',
+                 'fwhm': data[3],
+                 'image': record[0],
+                 'page': record[8],
+                 'roi': roi,
+                 'sigma': record[3],
+                 'sigma_line': record[4],
+                 'background': int(bool(record[5])),
+                 'params': self.engine.params}
+        if self.store_points is not None:
+            self.store_points.append(point)
+            return
+        try:
+            self.store.append([point])
+        except:
+            pass
+    
+    def begin_points(self):
+        """ Collect the points stored from now on, until end_points. """
+        self.store_points = []
+    
+    def end_points(self):
+        """ Store the points collected since begin_points in one commit. """
+        points, self.store_points = self.store_points, None
+        if points and (self.store is not None):
+            try:
+                self.store.append(points)
+            except:
+                pass
+    
+    def show_store_page(self, page):
+        """ Show one page of the results store in the table, the preview
+            follows the table.
+        """
+        if self.store is None:
+            return
+        n = self.store.count()
+        page = min(max(page, 0), max((n-1)//_page_size, 0))
+        self.store_page = page
+        self.table.clear_data()
+        pairs = []
+        for point in self.store.query(page*_page_size):
+            data = [str(point['wavelength']) if point['wavelength'] is not None else '',
+                    '{0:.2f}'.format(point['reflectivity']) \
+                            if point['reflectivity'] is not None else '',
+                    point['polarization'],
+                    str(point['fwhm']) if point['fwhm'] is not None else '']
+            rect = self.to_sel_rect(point['roi']) if point['roi'] else QtCore.QRect()
+            record = [point['image'], self.scale_factor, rect, point['sigma'],
+                    point['sigma_line'], bool(point['background']), 0, 0, point['page']]
+            pairs.append((data, record))
+        self.table.add_many(pairs)
+        self.update_export()
+        if self.plot.isVisible():
+            self.plot.canvas.update_figure()
+        self.parent().setWindowTitle('NPC Analyzer {0} - results store page {1}/{2}'.format(
+                __version__, page+1, max((n-1)//_page_size, 0)+1))
+        self.parent().update_actions()
+    
+    def browse_store(self):
+        self.show_store_page(0)
+    
+    def next_store_page(self):
+        self.show_store_page(self.store_page+1)
+    
+    def prev_store_page(self):
+        self.show_store_page(self.store_page-1)
+    
     def preview(self, pressed):
         self.sender().setText(["✪", "✩"][pressed])
         self.sender().setToolTip(['Preview data', 'Hide preview window'][pressed])
@@ -1478,98 +4450,15 @@ class ImageDisplay(QtGui.QWidget):
             self.plot.setVisible(False)
     
     # analysis methods
-    def p_isvalid(self, dmax, i, N, x, y):
-        z = x+y*1j
-        return (np.abs(z) >= dmax) and (np.pi/N*2*i <= self.angle(z) <= np.pi/N*2*(i+1))
-    
-    def isvalid(self, dmax, i, N, x1, x2, y1, y2):
-        valid = self.p_isvalid(dmax, i, N, x1, y1) and self.p_isvalid(dmax, i, N, x1, y2) \
-                and self.p_isvalid(dmax, i, N, x2, y1) and self.p_isvalid(dmax, i, N, x2, y2)
-        return valid
-    
-    def angle(self, z):
-        return np.angle(z) if np.angle(z) >= 0 else 2*np.pi+np.angle(z)
-    
-    def inner_optimizer(self, x1, y1, xc, yc, dmin, std, factor):
-        """ Get the inner brightness and rect for the selected area.
-        
-        Note that when selected area is empty, brightness would be set to -1.
-        Make sure that the image exists before calling this method.
-        
-        Returns:
-        float brightnss, QRect rect.
-        """
-        inner_b = -1
-        inner_rect = QtCore.QRect()
-        
-        eta = 1.0
-        while True:
-            a = eta*dmin/np.sqrt(2)
-            x1_i = x1+round(xc-a)
-            x2_i = x1+round(xc+a)
-            y1_i = y1+round(yc-a)
-            y2_i = y1+round(yc+a)
-            inner_block = self.matrix[y1_i:y2_i, x1_i:x2_i]
-            inner_rect = QtCore.QRect(x1_i, y1_i, x2_i-x1_i, y2_i-y1_i)
-            if inner_block.size:
-                inner_b = np.mean(inner_block)
-                std_i = np.std(inner_block)
-                if std_i <= std:
-                    break
-                else:
-                    eta *= factor
-            else:
-                break
-        return inner_b, inner_rect
-    
-    def outer_optimizer(self, x1, y1, xc, yc, dmax, std, factor, N=4):
-        """ Get the inner brightness and rect for the selected area.
-        
-        Note that when selected area is empty, brightness would be set to -1.
-        Make sure that the image exists before calling this method.
-        
-        Returns:
-        array b_list, QPolygon rect_list.
+    def sel_roi(self, rect=None):
+        """ The selected area, or the given label rect, as a native
+            (x, y, w, h) roi, None if nothing is selected.
         """
-        outer_b_list = []
-        outer_rect_list = []
-        for i in range(N):
-            outer_b = -1
-            outer_rect = QtCore.QRect()
-            
-            eta = 1.0
-            d = 1.2*dmax
-            while True:
-                a = 1.0*eta
-                xc_o = d*np.cos(np.pi/N*(2*i+1))
-                yc_o = d*np.sin(np.pi/N*(2*i+1))
-                x1_o = xc_o-a
-                x2_o = xc_o+a
-                y1_o = yc_o-a
-                y2_o = yc_o+a
-                if self.isvalid(dmax, i, N, x1_o, x2_o, y1_o, y2_o):
-                    x1_o = max(round(x1+xc+x1_o), 0)
-                    x2_o = max(round(x1+xc+x2_o), 0)
-                    y1_o = max(round(y1+yc+y1_o), 0)
-                    y2_o = max(round(y1+yc+y2_o), 0)
-                    outer_block = self.matrix[y1_o:y2_o, x1_o:x2_o]
-                    if outer_block.size:
-                        brightness = np.mean(outer_block)
-                        std_o = np.std(outer_block)
-                        if std_o <= std:
-                            eta *= factor
-                            outer_b = brightness
-                            outer_rect = QtCore.QRect(x1_o, y1_o, x2_o-x1_o, y2_o-y1_o)
-                        else:
-                            break
-                    else:
-                        eta *= factor
-                        continue
-                else:
-                    break
-            outer_b_list.append(outer_b)
-            outer_rect_list.append(outer_rect)
-        return outer_b_list, outer_rect_list
+        rect = (self.lbl.sel_rect if rect is None else rect).normalized()
+        if rect.isEmpty():
+            return None
+        x1, x2, y1, y2 = self.native_bounds(rect)
+        return (x1, y1, x2-x1, y2-y1)
     
     def get_edges(self, sigma=None):
         """ Get the edges in current image. If image is None, returns None, 0, 0.
@@ -1583,18 +4472,7 @@ class ImageDisplay(QtGui.QWidget):
         
         if self.image and self.analyze_btn.isChecked():
             sigma = self.sigma_value_spin.value() if sigma == None else sigma
-            imag = self.matrix
-            rect = self.lbl.sel_rect.normalized()
-            if rect.isEmpty():
-                edges = filter.canny(imag, sigma=sigma)
-            else:
-                x1 = max(rect.left()-1, 0)
-                x2 = rect.right()
-                y1 = max(rect.top()-1, 0)
-                y2 = rect.bottom()
-                part = imag[y1:y2, x1:x2]
-                if part.size:
-                    edges = filter.canny(part, sigma=sigma)
+            edges, x1, y1 = self.engine.edges(self.matrix, sigma, self.sel_roi())
         return edges, x1, y1
     
     def get_lines(self, method=0):
@@ -1607,59 +4485,128 @@ class ImageDisplay(QtGui.QWidget):
         
         sigma = self.sigma_line_value_spin.value()
         edges, x1, y1 = self.get_edges(sigma)
-        if edges != None:
-            if method == 0:
-                h, theta, d = transform.hough_line(edges)
-                rows, cols = edges.shape
-                for _, angle, dist in zip(*transform.hough_line_peaks(h, theta, d)):
-                    x1_l = x1
-                    y1_l = y1+round((dist-0*np.cos(angle))/np.sin(angle))
-                    x2_l = x1+cols
-                    y2_l = y1+round((dist-cols*np.cos(angle))/np.sin(angle))
-                    x1_r = x1+round((dist-0*np.sin(angle))/np.cos(angle))
-                    y1_r = y1
-                    x2_r = x1+round((dist-rows*np.sin(angle))/np.cos(angle))
-                    y2_r = y1+rows
-                    X = [x1_l, x2_l, x1_r, x2_r]
-                    Y = [y1_l, y2_l, y1_r, y2_r]
-                    # don't know why on windows the x and y will be np.float64... so
-                    # converting to integer to prevent this
-                    p = [QtCore.QPoint(int(x), int(y)) for (x, y) in sorted(zip(X, Y))]
-                    lines.append(QtCore.QLine(p[1], p[2]))
-            elif method == 1:
-                lines = transform.probabilistic_hough_line(edges, threshold=50,
-                        line_length=round(80*self.scale_factor),
-                        line_gap=round(5*self.scale_factor))
-                lines = [QtCore.QLine(QtCore.QPoint(*line[0]), \
-                        QtCore.QPoint(*line[1])).translated(x1, y1) for line in lines]
-            else:
-                pass
+        if edges is not None and method in [0, 1]:
+            lines = [QtCore.QLine(*[int(v) for v in line]) \
+                    for line in self.engine.hough_lines(edges, x1, y1, method)]
         return lines
     
+    def cache_key(self, kind, sigma):
+        """ Key of the current analysis in the result cache, None if there
+            is no cache or nothing to analyze.
+        """
+        if not (self.image and self.analyze_btn.isChecked()):
+            return None
+        background = self.background if self.bg_cbox.isChecked() else ''
+        page = self.page if self.engine.is_stack(self.image) else None
+        return self.engine.cache_key(self.image, background, page, self.sel_roi(),
+                sigma, kind)
+    
     def analyze(self):
-        inner_b, inner_rect = None, QtCore.QRect()
-        outer_b_list, outer_rect_list = [], []
-        edge_points = QtGui.QPolygon()
-        
-        edges, x1, y1 = self.get_edges()
-        if edges != None:
-            h, w = edges.shape
-            mask = (edges != 0)
-            if mask.any():
-                x = (edges*np.arange(w))[mask]
-                y = (edges*(np.arange(h).reshape(-1, 1)))[mask]
-                for i in range(len(x)):
-                    edge_points.append(QtCore.QPoint(x1+x[i], y1+y[i]))
-                edge_points = QtGui.QPolygon(edge_points)
-                xc = np.mean(x)
-                yc = np.mean(y)
-                d = np.sqrt((x-xc)**2+(y-yc)**2)
-                d_min = np.min(d)
-                d_max = np.max(d)
-                inner_b, inner_rect = self.inner_optimizer(x1, y1, xc, yc, d_min, 10.0, 0.9)
-                outer_b_list, outer_rect_list = self.outer_optimizer(x1, y1, xc,
-                        yc, d_max, 3.0, 1.1, 10)
-        return inner_b, inner_rect, outer_b_list, outer_rect_list, edge_points
+        if not (self.image and self.analyze_btn.isChecked()) or self.matrix is None:
+            return self.engine.empty_result()
+        sigma = self.sigma_value_spin.value()
+        key = self.cache_key('analysis', sigma)
+        result = self.engine.cache_get(key)
+        if (result is None) or ('edge_points' not in result): # batch results have none
+            result = self.engine.analyze_matrix(self.matrix, self.sel_roi(), sigma,
+                    self.integral, self.masked)
+            self.engine.cache_put(key, result, edge_points=True)
+        return result
+    
+    def mask_lines(self, enabled):
+        self.engine.params['mask_lines'] = enabled
+        if self.analyze_btn.isChecked() and self.image:
+            self.update_total('analyze')
+    
+    def enable_cache(self, enabled):
+        self.engine.cache = None
+        if enabled:
+            try:
+                self.engine.cache = ResultCache()
+            except:
+                self.parent().cache_act.setChecked(False)
+    
+    # roi methods
+    def to_sel_rect(self, roi):
+        """ Map a native roi back to a selection rect on the label. """
+        x, y, w, h = roi
+        s = self.scale_factor
+        return QtCore.QRect(QtCore.QPoint(round(s*x)+1, round(s*y)+1),
+                QtCore.QPoint(round(s*(x+w)), round(s*(y+h))))
+    
+    def auto_roi(self):
+        """ Move the selection onto the pattern found by the engine. The size
+            of the current selection is kept, if there is one.
+        """
+        if self.image and (self.matrix is not None):
+            roi = self.sel_roi()
+            size = roi[2:] if roi else None
+            roi = self.engine.locate_pattern(self.matrix, size)
+            if roi:
+                self.lbl.sel_rect = self.to_sel_rect(roi)
+    
+    def auto_roi_act(self):
+        self.auto_roi()
+        self.update_total('rect')
+        self.lbl.update()
+    
+    def track(self):
+        """ Register the new frame against the previous one and let the
+            selection and the rois follow the drift of the sample.
+        """
+        if self.matrix is None:
+            self.track_ref = None
+            return
+        small = self.engine.downsample(self.matrix, _track_factor)
+        ref = self.track_ref
+        if (ref is not None) and (ref.shape == small.shape):
+            dx, dy = self.engine.phase_shift(ref, small)
+            dx, dy = _track_factor*dx, _track_factor*dy
+            shape = self.matrix.shape
+            roi = self.sel_roi()
+            if roi:
+                roi = self.engine.shift_roi(roi, dx, dy, shape)
+                self.lbl.sel_rect = self.to_sel_rect(roi)
+            self.rois = [self.engine.shift_roi(roi, dx, dy, shape) for roi in self.rois]
+        self.track_ref = small
+    
+    def reset_track(self):
+        self.track_ref = None
+        if self.parent().track_act.isChecked() and (self.matrix is not None):
+            self.track_ref = self.engine.downsample(self.matrix, _track_factor)
+    
+    def add_roi(self):
+        roi = self.sel_roi()
+        if self.image and roi and (roi not in self.rois):
+            self.rois.append(roi)
+            self.update_rois()
+    
+    def clear_rois(self):
+        self.rois = []
+        self.update_rois()
+    
+    def analyze_rois(self):
+        """ Analyze all the rois of the current frame in one pass, and add
+            one data point for each roi that gives a reflectivity.
+        """
+        if not (self.image and self.rois and self.info['wavelength']):
+            return
+        results = self.engine.analyze_rois(self.matrix, self.rois,
+                self.sigma_value_spin.value(), self.integral)
+        self.begin_points()
+        try:
+            for roi, result in zip(self.rois, results):
+                if result['reflectivity']:
+                    data = [self.info['wavelength'],
+                            '{0:.2f}'.format(100*result['reflectivity']),
+                            self.info['polarization'],
+                            self.info['FWHM']]
+                    self.table.add_data(data, self.to_sel_rect(roi))
+        finally:
+            self.end_points()
+        self.update_export()
+        if self.plot.isVisible():
+            self.plot.canvas.update_figure()
     
     def do_analyze(self, pressed):
         self.sender().setText(["Analyze", "Origin"][pressed])
@@ -1669,6 +4616,225 @@ class ImageDisplay(QtGui.QWidget):
     def do_analyze_act(self):
         self.analyze_btn.click()
     
+    def analyze_cube(self):
+        """ Apply the squares of the current analysis to every image of the
+            current directory at once, and add one data point per image.
+        """
+        if not (self.image and self.analyze_btn.isChecked() and \
+                not self.inner_rect.isEmpty()):
+            msg = 'Please analyze one image of the series first, its squares '\
+                    'will be used for the whole series.'
+            QtGui.QMessageBox.information(self, 'Analyze series', msg)
+            return
+        path = self.path_list.currentText()
+        images = [os.path.join(path, self.imag_list.itemText(i)) \
+                for i in range(self.imag_list.count())]
+        use_cal = self.cal_cbox.isChecked() and self.cal
+        cal_data = self.cal_data if use_cal else None
+        background = bool(use_cal and self.bg_cbox.isChecked())
+        key = (tuple(images), self.cal if use_cal else '', background)
+        QtGui.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+        try:
+            if key != self.cube_key:
+                if self.cube is not None:
+                    self.cube.close()
+                self.cube = SpectralCube(self.engine, images, cal_data, background)
+                self.cube_key = key
+            r = self.inner_rect
+            inner_rect = (r.x(), r.y(), r.width(), r.height())
+            outer_rects = [(r.x(), r.y(), r.width(), r.height()) \
+                    for r in self.outer_rects if not r.isEmpty()]
+            valid = self.engine.line_valid(self.matrix, self.sel_roi())
+            reflectivity = self.cube.reflectivity(inner_rect, outer_rects, valid)
+        finally:
+            QtGui.QApplication.restoreOverrideCursor()
+        if reflectivity is None:
+            return
+        self.begin_points()
+        try:
+            for image, page, info, value in zip(self.cube.images, self.cube.pages,
+                    self.cube.infos, reflectivity):
+                if value:
+                    data = [info['wavelength'], '{0:.2f}'.format(100*value),
+                            info['polarization'], info['FWHM']]
+                    self.table.add_data(data, image=image, page=page)
+        finally:
+            self.end_points()
+        self.update_export()
+        if self.plot.isVisible():
+            self.plot.canvas.update_figure()
+    
+    def batch_analyze(self):
+        """ Analyze every image of the current directory with the current
+            selection and sigma in a background process pool, one worker per
+            polarization, and add the results to the table.
+        """
+        if self.worker is not None:
+            return
+        path = self.path_list.currentText()
+        images = [os.path.join(path, self.imag_list.itemText(i)) \
+                for i in range(self.imag_list.count())]
+        use_cal = self.cal_cbox.isChecked() and self.cal
+        cal_data = self.cal_data if use_cal else None
+        background = bool(use_cal and self.bg_cbox.isChecked())
+        if self.parent().pipeline_act.isChecked():
+            runner = Pipeline(self.engine.params)
+        else:
+            cache = self.engine.cache.filename if self.engine.cache else None
+            runner = BatchRunner(self.engine.params, cache=cache)
+        self.start_worker(runner.run, self.add_results, images,
+                self.batch_roi(), self.batch_sigma(), cal_data, background)
+    
+    def watch(self, enabled):
+        """ Start or stop analyzing the frames dropped in the current
+            directory, with the current selection, sigma and calibration.
+        """
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher.wait()
+            self.watcher = None
+        path = self.path_list.currentText()
+        if not (enabled and os.path.isdir(path)):
+            self.parent().watch_act.setChecked(False)
+            return
+        use_cal = self.cal_cbox.isChecked() and self.cal
+        cal_data = self.cal_data if use_cal else None
+        background = bool(use_cal and self.bg_cbox.isChecked())
+        cache = self.engine.cache.filename if self.engine.cache else None
+        self.watcher = MyWatcher(self, path, self.engine.params, self.batch_roi(),
+                self.batch_sigma(), cal_data, background, cache)
+        self.watcher.done.connect(self.add_results)
+        self.watcher.failed.connect(self.worker_failed)
+        self.watcher.start()
+    
+    def auto_sigma(self):
+        """ Find a stable sigma for the current frame in the background. """
+        if not (self.image and self.analyze_btn.isChecked()) or self.worker is not None:
+            return
+        engine = NPCEngine(self.engine.params) # the gui keeps analyzing with its own
+        self.start_worker(engine.auto_sigma, self.auto_sigma_finished,
+                self.matrix, self.sel_roi(), _sigmas, self.integral)
+    
+    def auto_sigma_finished(self, result):
+        self.sigma_value_spin.setValue(result[0]) # analyzes again
+    
+    def batch_roi(self):
+        """ Roi for batch jobs, 'auto' to locate the pattern in each frame. """
+        if self.parent().auto_roi_always_act.isChecked():
+            return 'auto'
+        return self.sel_roi()
+    
+    def batch_sigma(self):
+        """ Canny sigma for batch jobs, None to choose it for each frame. """
+        if self.parent().auto_sigma_batch_act.isChecked():
+            return None
+        return self.sigma_value_spin.value()
+    
+    def set_outer_method(self, annulus):
+        self.engine.params['outer_method'] = 'annulus' if annulus else 'squares'
+        if self.image:
+            self.update_total('analyze')
+    
+    def set_line_window(self):
+        value, ok = QtGui.QInputDialog.getDouble(self, 'Line angle window',
+                'Half width of the line angles around 0 and 90 degrees:',
+                self.engine.params['line_window'], 1.0, 45.0, 1)
+        if ok:
+            self.engine.params['line_window'] = value
+            if self.analyze_btn.isChecked() and self.image:
+                self.update_total('analyze')
+    
+    def sweep(self):
+        """ Sweep sigma and the optimizer parameters around their current
+            values over frames of the current directory.
+        """
+        if self.worker is not None:
+            return
+        path = self.path_list.currentText()
+        images = [os.path.join(path, self.imag_list.itemText(i)) \
+                for i in range(self.imag_list.count())]
+        if not images:
+            return
+        step = max(len(images)//_sweep_frames, 1)
+        images = images[::step][:_sweep_frames]
+        sigma = self.sigma_value_spin.value()
+        p = self.engine.params
+        values = {'sigma': sorted(set(max(sigma+d, 0.0) for d in [-1.0, -0.5, 0.0, 0.5, 1.0])),
+                  'inner_std': [0.5*p['inner_std'], p['inner_std'], 1.5*p['inner_std']],
+                  'inner_factor': [p['inner_factor']-0.05, p['inner_factor'],
+                          p['inner_factor']+0.05],
+                  'outer_std': [p['outer_std']-1.0, p['outer_std'], p['outer_std']+1.0],
+                  'outer_factor': [p['outer_factor'], p['outer_factor']+0.1],
+                  'outer_n': [p['outer_n']-2, p['outer_n'], p['outer_n']+2]}
+        use_cal = self.cal_cbox.isChecked() and self.cal
+        cal_data = self.cal_data if use_cal else None
+        background = bool(use_cal and self.bg_cbox.isChecked())
+        sweep = ParameterSweep(self.engine.params)
+        self.start_worker(sweep.run, self.sweep_finished, images, values,
+                self.batch_roi(), cal_data, background)
+    
+    def sweep_finished(self, columns):
+        if not columns or not len(columns['deviation']):
+            return
+        keys = ['sigma', 'inner_std', 'inner_factor', 'outer_std', 'outer_factor', 'outer_n']
+        lines = ['  '.join(keys+['R [%]', 'deviation', 'failed'])]
+        for i in range(min(10, len(columns['deviation']))):
+            lines.append('  '.join(['{0:g}'.format(columns[key][i]) for key in keys] +
+                    ['{0:.2f}'.format(columns['reflectivity'][i]),
+                     '{0:.4f}'.format(columns['deviation'][i]),
+                     '{0}'.format(columns['failed'][i])]))
+        msg = 'Most stable settings:\n\n'+'\n'.join(lines)+'\n\nApply the first ones?'
+        reply = QtGui.QMessageBox.question(self, 'Parameter sweep', msg,
+                QtGui.QMessageBox.Yes | QtGui.QMessageBox.No, QtGui.QMessageBox.No)
+        if reply == QtGui.QMessageBox.Yes:
+            for key in keys[1:]:
+                value = columns[key][0]
+                self.engine.params[key] = int(value) if key == 'outer_n' else float(value)
+            sigma = float(columns['sigma'][0])
+            if sigma == self.sigma_value_spin.value():
+                self.update_total('sigma_edge') # only the parameters changed
+            else:
+                self.sigma_value_spin.setValue(sigma) # analyzes again
+    
+    def start_worker(self, function, slot, *args, **kwargs):
+        """ Run function(*args, **kwargs) on a MyWorker, slot gets the result. """
+        self.worker = worker = MyWorker(self, function, *args, **kwargs)
+        worker.done.connect(slot)
+        worker.failed.connect(self.worker_failed)
+        worker.finished.connect(self.worker_finished)
+        self.parent().batch_act.setEnabled(False)
+        self.parent().sweep_act.setEnabled(False)
+        self.parent().auto_sigma_act.setEnabled(False)
+        worker.start()
+    
+    def worker_failed(self, msg):
+        QtGui.QMessageBox.information(self, 'Shit happens', msg)
+    
+    def worker_finished(self):
+        self.worker = None
+        self.parent().update_actions()
+    
+    def add_results(self, results):
+        """ Add a data point for each result dict given by the engine. """
+        self.begin_points()
+        try:
+            for result in results:
+                if result['reflectivity'] and result['wavelength']:
+                    # the roi the job used, the selection may have moved since
+                    roi = result.get('roi')
+                    rect = self.to_sel_rect(roi) if roi else QtCore.QRect()
+                    data = [result['wavelength'],
+                            '{0:.2f}'.format(100*result['reflectivity']),
+                            result['polarization'],
+                            result['FWHM']]
+                    self.table.add_data(data, rect, result['image'], result['page'],
+                            sigma=result.get('sigma'))
+        finally:
+            self.end_points()
+        self.update_export()
+        if self.plot.isVisible():
+            self.plot.canvas.update_figure()
+    
     # update methods
     def update_total(self, kind):
         # this method takes care of everything
@@ -1676,6 +4842,12 @@ class ImageDisplay(QtGui.QWidget):
             self.update_exp_info()
             self.parent().update_actions()
             self.update_matrix()
+            if self.restoring:
+                self.reset_track() # the recorded selection is not moved
+            elif self.parent().track_act.isChecked():
+                self.track()
+            if self.parent().auto_roi_always_act.isChecked() and not self.restoring:
+                self.auto_roi()
             if self.analyze_btn.isChecked():
                 self.update_lines()
                 self.update_paint()
@@ -1690,12 +4862,10 @@ class ImageDisplay(QtGui.QWidget):
                 self.scale_factor = zoom
                 self.parent().zoomin_act.setEnabled(self.scale_factor < 5.0)
                 self.parent().zoomout_act.setEnabled(self.scale_factor > 0.2)
-                self.update_matrix()
+                # the matrix and the analysis results are native, zooming
+                # only changes how they are mapped onto the label
                 self.update_scrollbar(factor)
                 self.update_rect(factor)
-                if self.analyze_btn.isChecked():
-                    self.update_lines()
-                    self.update_paint()
                 self.update_imag()
                 self.update_window()
         elif kind == 'rect':
@@ -1715,6 +4885,8 @@ class ImageDisplay(QtGui.QWidget):
                     self.sigma_line_value_spin.value() > 0.0)
             if self.analyze_btn.isChecked() and self.image:
                 self.update_lines(1)
+                if self.engine.params['mask_lines']:
+                    self.update_paint(1) # the lines change the reflectivity
         elif kind == 'repaint':
             if self.analyze_btn.isChecked() and self.image:
                 self.update_paint(1)
@@ -1733,22 +4905,19 @@ class ImageDisplay(QtGui.QWidget):
     
     def update_matrix(self):
         try:
-            array = io.imread(self.image)
-            gray = self.array2gray(array)
-            if self.bg_cbox.isChecked() and self.background:
-                bg_array = io.imread(self.background)
-                bg_gray = self.array2gray(bg_array)
-                gray = gray.astype(int)-bg_gray.astype(int)
-                gray[gray < 0] = 0
-                gray = np.require(gray, np.uint8, 'C')
-            gray = 255*transform.rescale(gray, self.scale_factor, mode='nearest')
-            self.matrix = np.require(gray, np.uint8, 'C')
+            background = self.background if self.bg_cbox.isChecked() else ''
+            page = self.page if self.engine.is_stack(self.image) else None
+            self.matrix = self.engine.load_gray(self.image, background, page)
+            self.integral = self.engine.integral(self.matrix)
         except:
             self.matrix = None
+            self.integral = None
+        self.masked = None
+        self.lbl.invalidate('image')
     
     def update_imag(self):
+        self.lbl.invalidate('image', 'analysis')
         if self.image:
-            pixmap = QtGui.QPixmap.fromImage(self.gray2qimage(self.matrix))
             self.scroll.setWidgetResizable(False)
             self.zoom_sld.setEnabled(True)
             self.parent().fit_to_image_act.setEnabled(True)
@@ -1757,7 +4926,6 @@ class ImageDisplay(QtGui.QWidget):
             self.scroll.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
             
             self.lbl.resize(self.lbl.sizeHint())
-            self.lbl.setPixmap(pixmap)
         else:
             self.scroll.setWidgetResizable(True)
             self.zoom_sld.setEnabled(False)
@@ -1795,8 +4963,10 @@ class ImageDisplay(QtGui.QWidget):
         self.name_parser(name)
         self.set_background()
         self.update_add()
+        self.lbl.invalidate('info')
     
     def update_stat(self):
+        self.lbl.invalidate('stat')
         for key in self.stat.keys():
             self.stat[key] = ''
         
@@ -1805,10 +4975,7 @@ class ImageDisplay(QtGui.QWidget):
             if rect.isEmpty():
                 matrix = self.matrix
             else:
-                x1 = max(rect.left()-1, 0)
-                x2 = rect.right()
-                y1 = max(rect.top()-1, 0)
-                y2 = rect.bottom()
+                x1, x2, y1, y2 = self.native_bounds(rect)
                 matrix = self.matrix[y1:y2, x1:x2]
             if matrix.size:
                 self.stat['maximum'] = '{0:d}'.format(np.max(matrix))
@@ -1833,6 +5000,11 @@ class ImageDisplay(QtGui.QWidget):
             self.replace_btn.setEnabled(False)
             self.parent().replace_act.setEnabled(False)
     
+    def update_rois(self):
+        self.parent().clear_rois_act.setEnabled(bool(self.rois))
+        self.parent().analyze_rois_act.setEnabled(bool(self.rois and self.image))
+        self.lbl.update()
+    
     def update_export(self):
         if self.table.rowCount():
             self.export_btn.setEnabled(True)
@@ -1849,19 +5021,19 @@ class ImageDisplay(QtGui.QWidget):
         repaint -- if 0, this method just update the label drawing contents;
             if 1, this method will repaint the label drawings
         """
-        inner_b, self.inner_rect, outer_bs, self.outer_rects, \
-                self.edge_points = self.analyze()
+        result = self.analyze()
+        self.inner_rect = QtCore.QRect(*result['inner_rect'])
+        self.outer_rects = [QtCore.QRect(*rect) for rect in result['outer_rects']]
+        self.edge_points = result['edge_points']
         ref_text = ''
-        if inner_b != None:
-            reflectivity = self.cal_reflectivity(inner_b, outer_bs)
-            if reflectivity:
-                ref_text = '{0:.2f}'.format(100*reflectivity)
+        if result['reflectivity']:
+            ref_text = '{0:.2f}'.format(100*result['reflectivity'])
         self.info['reflectivity'] = ref_text
         self.update_add()
+        self.lbl.invalidate('analysis', 'info')
         if repaint:
             self.lbl.update()
     
-    # TODO: update lines should also change the reflectivity value.
     def update_lines(self, repaint=0):
         """ Analyze the selected area and update the lines painted,
             and set the label which displays the reflectivity values.
@@ -1870,7 +5042,21 @@ class ImageDisplay(QtGui.QWidget):
         repaint -- if 0, this method just update the label drawing contents;
             if 1, this method will repaint the label drawings
         """
-        self.lines = self.get_lines()
+        key = self.cache_key('lines', self.sigma_line_value_spin.value())
+        lines = self.engine.cache_get(key)
+        if lines is None:
+            self.lines = self.get_lines()
+            self.engine.cache_put(key, [(line.x1(), line.y1(), line.x2(), line.y2()) \
+                    for line in self.lines])
+        else:
+            self.lines = [QtCore.QLine(*line) for line in lines]
+        self.masked = None
+        if self.matrix is not None:
+            # masked once per line update, every analysis until the next reuses it
+            lines = [(line.x1(), line.y1(), line.x2(), line.y2()) for line in self.lines]
+            self.masked = self.engine.mask_integral(self.matrix, self.sel_roi(),
+                    self.integral, lines)
+        self.lbl.invalidate('analysis')
         if repaint:
             self.lbl.update()
     
@@ -1950,4 +5136,20 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if sys.argv[1:2] == ['--serve']:
+        serve(*[int(v) for v in sys.argv[2:4]]) # analyzer.py --serve [port [workers]]
+    elif sys.argv[1:2] == ['--campaign']:
+        Campaign(sys.argv[3:], sys.argv[2]).node() # analyzer.py --campaign output dir...
+    elif sys.argv[1:2] == ['--release']:
+        for directory in Campaign(sys.argv[3:], sys.argv[2]).release(): # analyzer.py --release output dir...
+            print('released {0}'.format(directory))
+    elif sys.argv[1:2] == ['--benchmark-outer']:
+        engine = NPCEngine() # analyzer.py --benchmark-outer image [sigma]
+        sigma = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+        for method, (seconds, reflectivity) in sorted(
+                engine.benchmark_outer(engine.load_gray(sys.argv[2]), None, sigma).items()):
+            print('{0}: {1:.2f} ms, reflectivity {2}'.format(method, 1000*seconds, reflectivity))
+    elif sys.argv[1:2] == ['--merge']:
+        Exporter().write_csv(sys.argv[3], Campaign([], sys.argv[2]).merge()) # analyzer.py --merge output csv
+    else:
+        main()
\ No newline at end of file